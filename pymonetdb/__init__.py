@@ -14,8 +14,9 @@ import pkg_resources
 from pymonetdb import sql
 from pymonetdb import mapi
 from pymonetdb import exceptions
+from pymonetdb import parallel
 
-from pymonetdb.sql.connections import Connection
+from pymonetdb.sql.connections import Connection, ThreadLocalConnections
 from pymonetdb.sql.pythonize import *
 from pymonetdb.exceptions import *
 
@@ -28,7 +29,7 @@ except pkg_resources.DistributionNotFound:
 
 __all__ = ["sql", "mapi", "exceptions"]
 apilevel = "2.0"
-threadsafety = 0
+threadsafety = 2
 paramstyle = "pyformat"
 
 __all__ = ['BINARY', 'Binary', 'connect', 'Connection', 'DATE',
@@ -37,7 +38,8 @@ __all__ = ['BINARY', 'Binary', 'connect', 'Connection', 'DATE',
            'FIELD_TYPE', 'IntegrityError', 'InterfaceError', 'InternalError',
            'MySQLError', 'NULL', 'NUMBER', 'NotSupportedError', 'DBAPISet',
            'OperationalError', 'ProgrammingError', 'ROWID', 'STRING', 'TIME',
-           'TIMESTAMP', 'Set', 'Warning', 'apilevel', 'connect',
+           'TIMESTAMP', 'Set', 'ThreadLocalConnections', 'Warning',
+           'apilevel', 'connect',
            'connections', 'constants', 'cursors', 'debug', 'escape',
            'escape_dict', 'escape_sequence', 'escape_string',
            'get_client_info', 'paramstyle', 'string_literal', 'threadsafety',
@@ -14,10 +14,15 @@ import struct
 import hashlib
 import os
 import string
-from six import BytesIO, PY3
+import itertools
+import threading
+import time
+import functools
+from collections import deque, namedtuple
+from six import BytesIO, PY3, text_type
 
 from pymonetdb.exceptions import OperationalError, DatabaseError,\
-    ProgrammingError, NotSupportedError, IntegrityError
+    ProgrammingError, NotSupportedError, IntegrityError, Error
 
 logger = logging.getLogger(__name__)
 
@@ -39,10 +44,50 @@ MSG_TUPLE = "["
 MSG_TUPLE_NOSLICE = "="
 MSG_REDIRECT = "^"
 MSG_OK = "=OK"
+MSG_FILETRANS = "\1\3\n"
 
 STATE_INIT = 0
 STATE_READY = 1
 
+# the default number of outstanding commands in a pipeline
+PIPELINE_WINDOW = 32
+
+# the outcome of a pipelined command, either response or error is set
+PipelineResult = namedtuple('PipelineResult', ('operation', 'response', 'error'))
+
+# the number of seconds a merovingian redirect is reused for
+REDIRECT_TTL = 60
+
+# resolved merovingian redirects, maps the (host, port, database) connected
+# to on the (host, port, database, expiry) of the mserver5 redirected to
+_redirects = {}
+
+
+def _cached_redirect(origin):
+    """ the (host, port, database) origin was redirected to, if known """
+    target = _redirects.get(origin)
+    if target is None:
+        return None
+    if target[3] < time.time():
+        _redirects.pop(origin, None)
+        return None
+    return target[:3]
+
+
+def locked(method):
+    """ serialises the calls of a method with the lock of the object, so
+    threads sharing a connection can't interleave their commands """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def clear_redirects():
+    """ forget the resolved merovingian redirects """
+    _redirects.clear()
+
 
 # MonetDB error codes
 errors = {
@@ -74,6 +119,29 @@ def handle_error(error):
         return OperationalError, error
 
 
+def _packets(fragments):
+    """ joins str or bytes fragments into buffers of at least
+    MAX_PACKAGE_LENGTH bytes, larger fragments are passed on as they are """
+    pending = []
+    size = 0
+    for fragment in fragments:
+        if isinstance(fragment, text_type):
+            fragment = fragment.encode('utf-8')
+        if len(fragment) >= MAX_PACKAGE_LENGTH:
+            if pending:
+                yield b"".join(pending)
+                pending, size = [], 0
+            yield fragment
+            continue
+        pending.append(fragment)
+        size += len(fragment)
+        if size >= MAX_PACKAGE_LENGTH:
+            yield b"".join(pending)
+            pending, size = [], 0
+    if pending:
+        yield b"".join(pending)
+
+
 def encode(s):
     """only encode string for python3"""
     if PY3:
@@ -88,6 +156,22 @@ def decode(b):
     return b
 
 
+class HandshakeOption(object):
+    """
+    A session option that can be set in the login response, saving a round
+    trip for its command. Servers accept the options with a level below the
+    one they announce in their challenge.
+    """
+
+    def __init__(self, level, name, value, command):
+        self.level = level
+        self.name = name
+        self.value = value
+        # the command setting the option after login
+        self.command = command
+        self.sent = False
+
+
 # noinspection PyExceptionInherit
 class Connection(object):
     """
@@ -106,14 +190,34 @@ class Connection(object):
         self.database = ""
         self.language = ""
         self.connect_timeout = socket.getdefaulttimeout()
-
+        # ask the server for the file transfer protocol during login
+        self.file_transfer = False
+        # session options to set during login, see HandshakeOption
+        self.handshake_options = []
+        # called as uploader(filename, binary, offset) when the server asks
+        # for a file ON CLIENT, returns an iterable of bytes-like objects
+        self.uploader = None
+        # the (host, port, database) connected to, for caching redirects
+        self._origin = None
+        # held while a command and its response are on the line
+        self.lock = threading.RLock()
+
+    @locked
     def connect(self, database, username, password, language, hostname=None,
-                port=None, unix_socket=None, connect_timeout=-1):
+                port=None, unix_socket=None, connect_timeout=-1,
+                handshake_options=None):
         """ setup connection to MAPI server
 
         unix_socket is used if hostname is not defined.
+
+        handshake_options is a list of HandshakeOption. After connecting
+        their sent attribute tells if the server accepted them during
+        login, the others still have to be set with their command.
         """
 
+        if handshake_options is not None:
+            self.handshake_options = handshake_options
+
         if hostname and hostname[:1] == '/' and not unix_socket:
             unix_socket = '%s/.s.monetdb.%d' % (hostname, port)
             hostname = None
@@ -135,6 +239,31 @@ class Connection(object):
         self.language = language
         self.unix_socket = unix_socket
 
+        origin = (hostname or unix_socket, port, database)
+        target = _cached_redirect(origin) if language != 'control' else None
+        if target:
+            # skip merovingian, connect to the mserver5 it redirected to before
+            self._origin = target
+            self.hostname, self.port, self.database = target
+            self.unix_socket = None
+            try:
+                self._open()
+                return
+            except (socket.error, Error) as e:
+                logger.info("cached redirect to monetdb://%s:%s/%s failed: %s" %
+                            (target + (e,)))
+                _redirects.pop(origin, None)
+                if self.socket:
+                    self.socket.close()
+                self.hostname, self.port, self.database = hostname, port, database
+                self.unix_socket = unix_socket
+
+        self._origin = origin
+        self._open()
+
+    def _open(self):
+        """ open the socket to hostname and port or unix_socket, and log in """
+        hostname, port, unix_socket = self.hostname, self.port, self.unix_socket
         if hostname:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # For performance, mirror MonetDB/src/common/stream.c socket settings.
@@ -194,6 +323,9 @@ class Connection(object):
                 self.hostname = redirect[2][2:]
                 self.port, self.database = redirect[3].split('/')
                 self.port = int(self.port)
+                _redirects[self._origin] = (self.hostname, self.port,
+                                            self.database,
+                                            time.time() + REDIRECT_TTL)
                 logger.info("redirect to monetdb://%s:%s/%s" %
                             (self.hostname, self.port, self.database))
                 self.socket.close()
@@ -207,28 +339,151 @@ class Connection(object):
         else:
             raise ProgrammingError("unknown state: %s" % prompt)
 
+    @locked
     def disconnect(self):
         """ disconnect from the monetdb server """
         logger.info("disconnecting from database")
         self.state = STATE_INIT
         self.socket.close()
 
-    def cmd(self, operation):
-        """ put a mapi command on the line"""
+    @locked
+    def cmd(self, operation, raw=False):
+        """ put a mapi command on the line. With raw a response holding
+        result rows is returned as undecoded bytes. """
         logger.debug("executing command %s" % operation)
 
         if self.state != STATE_READY:
-            raise(ProgrammingError, "Not connected")
+            raise ProgrammingError("Not connected")
 
         self._putblock(operation)
-        response = self._getblock()
+        return self._cmd_response(raw)
+
+    @locked
+    def cmd_chunks(self, chunks, raw=False):
+        """ like cmd() for a mapi command given as an iterable of str or
+        bytes fragments, which are put on the line while they are produced.
+        Small fragments are joined into packets.
+
+        The server can't be told to drop a partly sent command, so the
+        connection is closed when producing a fragment fails.
+        """
+        logger.debug("executing streamed command")
+
+        if self.state != STATE_READY:
+            raise ProgrammingError("Not connected")
+
+        try:
+            self._putbuffers(_packets(chunks))
+        except Exception:
+            self.disconnect()
+            raise
+        return self._cmd_response(raw)
+
+    def _cmd_response(self, raw):
+        response = self._getresponse(raw)
+        if response == MSG_MORE:
+            # tell server it isn't going to get more
+            return self.cmd("", raw)
+        if PY3 and isinstance(response, bytes):
+            return response
+        return self._handle_response(response)
+
+    @locked
+    def pipeline(self, operations, window=PIPELINE_WINDOW):
+        """ put many mapi commands on the line without waiting for the
+        response to each of them, then read the responses in order.
+
+        At most window commands are outstanding at any time, so neither
+        side blocks on full socket buffers while the other is writing.
+        Every SQL command but the last must end with a semicolon.
+
+        The server reads the commands following a command it asks more
+        input for as the rest of that command, after which the responses
+        can't be matched to the commands. That command and all following
+        fail then, and the connection is closed.
+
+        returns:
+            a list with a PipelineResult for each operation, holding either
+            the response or the exception it raised
+        """
+        logger.debug("pipelining commands")
+
+        if self.state != STATE_READY:
+            raise ProgrammingError("Not connected")
+        if window < 1:
+            raise ProgrammingError("window should be at least 1")
+        operations = list(operations)
+        for operation in operations[:-1]:
+            if operation.startswith('s') and not operation.rstrip().endswith(';'):
+                raise ProgrammingError("only the last pipelined command may "
+                                       "be incomplete: %s" % operation)
+
+        results = []
+        outstanding = deque()
+        for operation in operations:
+            if len(outstanding) >= window:
+                result = self._pipeline_result(outstanding.popleft(), False)
+                if result is None:
+                    return results + self._abort_pipeline(operations[len(results):])
+                results.append(result)
+            self._putblock(operation)
+            outstanding.append(operation)
+        while outstanding:
+            operation = outstanding.popleft()
+            result = self._pipeline_result(operation, not outstanding)
+            if result is None:
+                return results + self._abort_pipeline(operations[len(results):])
+            results.append(result)
+        return results
+
+    def _pipeline_result(self, operation, last):
+        """ the PipelineResult of a command, None if a command that isn't
+        the last one is incomplete """
+        response = self._getresponse()
+        while response == MSG_MORE and last:
+            # nothing follows, tell server it isn't going to get more
+            self._putblock("")
+            response = self._getresponse()
+        if response == MSG_MORE:
+            return None
+        try:
+            return PipelineResult(operation, self._handle_response(response), None)
+        except Error as e:
+            return PipelineResult(operation, None, e)
+
+    def _abort_pipeline(self, operations):
+        """ fail an incomplete command and the commands following it, the
+        responses still to come can't be matched to them """
+        self.disconnect()
+        error = ProgrammingError("incomplete command: %s" % operations[0])
+        results = [PipelineResult(operations[0], None, error)]
+        for operation in operations[1:]:
+            error = OperationalError("not executed as a command of its own "
+                                     "after an incomplete command: %s" % operation)
+            results.append(PipelineResult(operation, None, error))
+        return results
+
+    def _getresponse(self, raw=False):
+        """ read the response to a command, serving the file transfers the
+        server requests before it. With raw a response holding result rows
+        is returned as bytes, the others are decoded. """
+        if raw:
+            response = self._getblock(raw=True)
+            if response[:2] in (encode(MSG_QTABLE), encode(MSG_QBLOCK)):
+                return response
+            response = decode(response)
+        else:
+            response = self._getblock()
+        while response.endswith(MSG_FILETRANS):
+            response = self._transfer(response[:-len(MSG_FILETRANS)])
+        return response
+
+    def _handle_response(self, response):
+        """ check a response for errors and return its content """
         if not len(response):
             return ""
         elif response.startswith(MSG_OK):
             return response[3:].strip() or ""
-        if response == MSG_MORE:
-            # tell server it isn't going to get more
-            return self.cmd("")
 
         # If we are performing an update test for errors such as a failed
         # transaction.
@@ -258,6 +513,101 @@ class Connection(object):
         else:
             raise ProgrammingError("unknown state: %s" % response)
 
+    @locked
+    def cmd_stream(self, operation, write):
+        """ put a mapi command on the line and hand the raw bytes of the
+        response to write() as they arrive, without decoding them.
+
+        The protocol lines at the end of the response (the affected rows
+        count, errors, info messages) are not written but returned as a
+        string, all lines before them are data. An error in the response
+        raises an exception after the data preceding it has been written.
+        """
+        logger.debug("executing streaming command %s" % operation)
+
+        if self.state != STATE_READY:
+            raise ProgrammingError("Not connected")
+
+        self._putblock(operation)
+
+        # the last packet is held back together with the incomplete line
+        # before it, so the trailing protocol lines can be inspected
+        held = None
+        packets = self._getpackets()
+        for packet in packets:
+            if held is not None:
+                cut = held.rfind(b"\n") + 1
+                if cut:
+                    write(held[:cut])
+                packet = held[cut:] + packet
+            held = packet
+
+        lines = (held or b"").split(b"\n")
+        if lines and not lines[-1]:
+            # the newline ending the response
+            lines.pop()
+        cut = self._trailer_start(lines)
+        trailer = [decode(line) for line in lines[cut:]]
+        if cut:
+            write(b"\n".join(lines[:cut]) + b"\n")
+
+        for line in trailer:
+            if line.startswith(MSG_ERROR):
+                exception, string = handle_error(line[1:])
+                raise exception(string)
+            elif line.startswith(MSG_INFO):
+                logger.info("%s" % line[1:])
+        return "\n".join(line for line in trailer if line.startswith(MSG_Q))
+
+    @staticmethod
+    def _trailer_start(lines):
+        """ the index of the first protocol line ending a streamed response:
+        its status line, a single update line or the error lines, with the
+        info lines following it. Data lines that look like protocol lines
+        before the status are data. """
+        end = len(lines)
+        while end and lines[end - 1][:1] == encode(MSG_INFO):
+            end -= 1
+        if end and lines[end - 1][:1] == encode(MSG_Q):
+            return end - 1
+        start = end
+        while start and lines[start - 1][:1] == encode(MSG_ERROR):
+            start -= 1
+        if start == end:
+            # no status line, all lines are data
+            return len(lines)
+        return start
+
+    def _transfer(self, response):
+        """ serve the file transfer request on the last line of response and
+        return the response that follows it, prefixed with the preceding
+        lines """
+        head, _, request = response.rstrip('\n').rpartition('\n')
+        if request.startswith('rb '):
+            filename, binary, offset = request[3:], True, 0
+        elif request.startswith('r '):
+            offset, _, filename = request[2:].partition(' ')
+            binary, offset = False, int(offset)
+        else:
+            filename = None
+
+        if filename is None:
+            self._putblock("!HY000!unsupported file transfer request: %s\n" % request)
+        elif not self.uploader:
+            self._putblock("!HY000!no uploader set for %s\n" % filename)
+        else:
+            logger.debug("uploading %s" % filename)
+            try:
+                data = self.uploader(filename, binary, offset)
+            except Exception as e:
+                self._putblock("!HY000!%s\n" % e)
+            else:
+                # an empty line accepts the request, an empty block ends
+                # the file
+                self._putbuffers(itertools.chain([b"\n"], data))
+                self._putbuffers([])
+        return (head + '\n' if head else '') + self._getblock()
+
     def _challenge_response(self, challenge):
         """ generate a response to a mapi login challenge """
         challenges = challenge.split(':')
@@ -290,26 +640,54 @@ class Connection(object):
             raise NotSupportedError("Unsupported hash algorithms required"
                                     " for login: %s" % hashes)
 
-        return ":".join(["BIG", self.username, pwhash, self.language,
-                         self.database]) + ":"
-
-    def _getblock(self):
-        """ read one mapi encoded block """
+        response = ":".join(["BIG", self.username, pwhash, self.language,
+                             self.database]) + ":"
+        if self.file_transfer:
+            response += "FILETRANS:"
+
+        # servers supporting handshake options announce the level up to
+        # which they know them as sql=<level>
+        level = 0
+        for part in challenges[6:]:
+            if part.startswith("sql="):
+                try:
+                    level = int(part[4:])
+                except ValueError:
+                    raise OperationalError("invalid options level in server "
+                                           "challenge: %s" % part)
+        options = []
+        for option in self.handshake_options:
+            option.sent = option.level < level
+            if option.sent:
+                options.append("%s=%d" % (option.name, int(option.value)))
+        if options:
+            response += ",".join(options) + ":"
+        return response
+
+    def _getblock(self, raw=False):
+        """ read one mapi encoded block, as bytes with raw """
         if self.language == 'control' and not self.hostname:
             return self._getblock_socket()  # control doesn't do block splitting when using a socket
         else:
-            return self._getblock_inet()
+            return self._getblock_inet(raw)
 
-    def _getblock_inet(self):
+    def _getblock_inet(self, raw=False):
         result = BytesIO()
+        for packet in self._getpackets():
+            result.write(packet)
+        if raw:
+            return result.getvalue()
+        return decode(result.getvalue())
+
+    def _getpackets(self):
+        """ yield the raw packets of one mapi encoded block as they arrive """
         last = 0
         while not last:
             flag = self._getbytes(2)
             unpacked = struct.unpack('<H', flag)[0]  # little endian short
             length = unpacked >> 1
             last = unpacked & 1
-            result.write(self._getbytes(length))
-        return decode(result.getvalue())
+            yield self._getbytes(length)
 
     def _getblock_socket(self):
         buffer = BytesIO()
@@ -354,6 +732,25 @@ class Connection(object):
             self.socket.send(data)
             pos += length
 
+    def _putbuffers(self, buffers):
+        """ send an iterable of bytes-like objects as one mapi block, each
+        object is sliced into packets without copying it """
+        flag = None
+        for buf in buffers:
+            view = memoryview(buf)
+            for pos in range(0, len(view), MAX_PACKAGE_LENGTH):
+                if flag:
+                    self.socket.sendall(flag)
+                    self.socket.sendall(data)
+                data = view[pos:pos + MAX_PACKAGE_LENGTH]
+                flag = struct.pack('<H', len(data) << 1)
+        if flag:
+            flag = struct.pack('<H', (len(data) << 1) + 1)
+            self.socket.sendall(flag)
+            self.socket.sendall(data)
+        else:
+            self.socket.sendall(struct.pack('<H', 1))
+
     def __del__(self):
         if self.socket:
             self.socket.close()
@@ -0,0 +1,409 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+"""
+Reading and loading over several connections at once. Every connection is
+used by its own worker thread or process, so neither the socket of a single
+session nor a single Python thread decoding its results limits the
+throughput.
+"""
+
+import io
+import logging
+import threading
+import time
+from collections import deque
+
+from six import string_types
+
+from pymonetdb.exceptions import ProgrammingError, Error
+from pymonetdb.sql import connections as sql_connections, bulk
+
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport
+    futures = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# the placeholder in a query template replaced by a partition predicate
+PARTITION = '{partition}'
+
+executors = ('thread', 'process')
+outputs = ('rows', 'pandas', 'arrow')
+commit_modes = ('chunk', 'final')
+
+# the connection of a worker process, made for its first partition
+_process_connection = None
+
+
+def key_ranges(column, low, high, partitions):
+    """
+    Split an integer column in ranges of about the same number of values
+    between low and high, returned as predicates for the {partition}
+    placeholder of read(). The first range also holds the values below low
+    and NULL, the last the values from high on, so together the ranges
+    cover the whole table.
+    """
+    if partitions < 1:
+        raise ProgrammingError("partitions should be at least 1")
+    step = (high - low) / float(partitions)
+    bounds = sorted(set(int(round(low + step * i))
+                        for i in range(1, partitions)))
+    predicates = []
+    lower = None
+    for upper in bounds + [None]:
+        if lower is None and upper is None:
+            predicates.append("TRUE")
+        elif lower is None:
+            predicates.append("(%s < %d OR %s IS NULL)" % (column, upper, column))
+        elif upper is None:
+            predicates.append("%s >= %d" % (column, lower))
+        else:
+            predicates.append("%s >= %d AND %s < %d" % (column, lower,
+                                                        column, upper))
+        lower = upper
+    return predicates
+
+
+def _partition_query(query_template, partition):
+    """ the query and parameters reading a partition """
+    if isinstance(partition, string_types):
+        return query_template.replace(PARTITION, partition), None
+    return query_template, partition
+
+
+def _fetch(connection, query, parameters):
+    """ run a query, returns the column names and all rows """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, parameters)
+        names = [column.name for column in cursor.description or []]
+        return names, cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _read_in_process(query, parameters, connect_kwargs):
+    """ read a partition in a worker process, over the connection of the
+    process """
+    global _process_connection
+    if _process_connection is None or _process_connection.mapi is None:
+        _process_connection = sql_connections.Connection(**connect_kwargs)
+    return _fetch(_process_connection, query, parameters)
+
+
+def _results(query_template, partitions, workers, executor, connect_kwargs):
+    """ yields the (names, rows) of every partition in partition order,
+    with at most two partitions per worker read ahead """
+    local = None
+    if executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+        local = sql_connections.ThreadLocalConnections(**connect_kwargs)
+
+        def submit(query, parameters):
+            return pool.submit(lambda: _fetch(local.get(), query, parameters))
+    else:
+        pool = futures.ProcessPoolExecutor(workers)
+
+        def submit(query, parameters):
+            return pool.submit(_read_in_process, query, parameters,
+                               connect_kwargs)
+
+    pending = deque()
+    try:
+        for partition in partitions:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(submit(*_partition_query(query_template, partition)))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        if local is not None:
+            local.close()
+
+
+def _merged_rows(results):
+    for (_, rows) in results:
+        for row in rows:
+            yield row
+
+
+def read(query_template, partitions, connections=4, executor='thread',
+         output='rows', **connect_kwargs):
+    """
+    Run a query for every partition of a table over several connections
+    and merge the results in partition order.
+
+    A partition is either a predicate, which replaces the {partition}
+    placeholder in the query template, or the parameters the template is
+    executed with. key_ranges() makes predicates for an integer key.
+
+    With the 'process' executor every worker process decodes the results
+    of its own connection, so decoding isn't limited by a single Python
+    interpreter. The rows are sent back to the calling process pickled.
+
+    args:
+        query_template (str): the query, with a {partition} placeholder or
+                              parameters
+        partitions: a sequence of predicates or parameters
+        connections (int): the number of workers, each with a connection
+        executor (str): run the workers in a 'thread' or 'process' pool
+        output (str): 'rows' to return an iterator over the rows, as they
+                      are read, 'pandas' for a DataFrame, 'arrow' for an
+                      Arrow table
+        connect_kwargs: the arguments of pymonetdb.connect(), auto commit
+                        is on unless set otherwise
+
+    returns:
+        an iterator over the rows, a pandas DataFrame or an Arrow table
+    """
+    if futures is None:
+        raise ProgrammingError("parallel reads require concurrent.futures, "
+                               "install the futures package")
+    if executor not in executors:
+        raise ProgrammingError("executor should be one of %s, not %s" %
+                               (", ".join(executors), executor))
+    if output not in outputs:
+        raise ProgrammingError("output should be one of %s, not %s" %
+                               (", ".join(outputs), output))
+    if output == 'pandas' and pandas is None:
+        raise ProgrammingError("output 'pandas' requires pandas")
+    if output == 'arrow' and pyarrow is None:
+        raise ProgrammingError("output 'arrow' requires pyarrow")
+    if connections < 1:
+        raise ProgrammingError("connections should be at least 1")
+    connect_kwargs.setdefault('autocommit', True)
+
+    results = _results(query_template, partitions, connections, executor,
+                       connect_kwargs)
+    if output == 'rows':
+        return _merged_rows(results)
+
+    names = []
+    rows = []
+    for (names, partition_rows) in results:
+        rows.extend(partition_rows)
+    if output == 'pandas':
+        return pandas.DataFrame.from_records(rows, columns=names)
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in names]
+    return pyarrow.Table.from_arrays([pyarrow.array(column) for column in columns],
+                                     names=names)
+
+
+class _Worker(object):
+    """ the connection of a loader thread and the rows it loaded """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = 0
+        self.seconds = 0.0
+
+
+class ParallelLoader(object):
+    """
+    Loads a table over several connections at once. The input is split in
+    chunks of rows, every chunk is loaded with COPY FROM STDIN by one of the
+    worker threads, each with its own connection and server transaction.
+
+    With commit='chunk' every chunk is a transaction of its own, committed
+    when it is loaded and retried when it conflicts with a concurrent
+    transaction. With commit='final' the workers keep their transaction
+    open until all chunks are loaded and then commit one after the other,
+    an error rolls back the chunks of all workers not yet committed. There
+    are no retries then, a conflict raises.
+
+    After load() the reports attribute has a bulk.LoadReport for every
+    worker, with the rows it loaded and the time it spent loading them.
+    """
+
+    def __init__(self, table, workers=4, chunk_rows=100000, commit='chunk',
+                 retries=5, **connect_kwargs):
+        """
+        args:
+            table (str): name of the table to load into
+            workers (int): the number of worker threads and connections
+            chunk_rows (int): the number of rows loaded per COPY statement
+            commit (str): 'chunk' to commit every chunk, 'final' to commit
+                          when all chunks are loaded
+            retries (int): how often a conflicting chunk is retried
+            connect_kwargs: the arguments of pymonetdb.connect()
+        """
+        if futures is None:
+            raise ProgrammingError("parallel loading requires "
+                                   "concurrent.futures, install the futures "
+                                   "package")
+        if commit not in commit_modes:
+            raise ProgrammingError("commit should be one of %s, not %s" %
+                                   (", ".join(commit_modes), commit))
+        if workers < 1:
+            raise ProgrammingError("workers should be at least 1")
+        self.table = table
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.commit = commit
+        self.retries = retries
+        self.connect_kwargs = connect_kwargs
+        self.reports = []
+
+    def load(self, source, format='csv'):
+        """
+        Load all rows of a source into the table.
+
+        args:
+            source: the name of a text file or a file object in the given
+                    format, a data frame as accepted by write_frame(), or
+                    an iterable of rows
+            format (str): the format of files, one of the keys of
+                          cursors.copy_formats (default: "csv"). Chunks
+                          are cut between records, a quoted csv field may
+                          hold line breaks.
+
+        returns:
+            a bulk.LoadReport with the number of rows and the time it took
+        """
+        start = time.time()
+        local = threading.local()
+        lock = threading.Lock()
+        workers = []
+
+        def worker():
+            state = getattr(local, 'state', None)
+            if state is None:
+                kwargs = dict(self.connect_kwargs,
+                              autocommit=self.commit == 'chunk')
+                connection = sql_connections.Connection(**kwargs)
+                state = local.state = _Worker(connection)
+                with lock:
+                    workers.append(state)
+            return state
+
+        def load_chunk(table, data, rows, chunk_format):
+            state = worker()
+            started = time.time()
+
+            def copy(connection):
+                connection.cursor().copy_from(table, data, chunk_format, rows)
+            if self.commit == 'chunk':
+                state.connection.run_transaction(copy, retries=self.retries)
+            else:
+                copy(state.connection)
+            state.rows += rows
+            state.seconds += time.time() - started
+
+        pool = futures.ThreadPoolExecutor(self.workers)
+        pending = deque()
+        try:
+            for chunk in self._chunks(source, format):
+                if len(pending) >= 2 * self.workers:
+                    pending.popleft().result()
+                pending.append(pool.submit(load_chunk, *chunk))
+            while pending:
+                pending.popleft().result()
+            if self.commit == 'final':
+                for state in workers:
+                    state.connection.commit()
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for state in workers:
+                # rolls back what wasn't committed
+                try:
+                    state.connection.close()
+                except Error as e:
+                    logger.warning("closing loader connection failed: %s" % e)
+
+        self.reports = [bulk.LoadReport(state.rows, state.seconds)
+                        for state in workers]
+        report = bulk.LoadReport(sum(state.rows for state in workers),
+                                 time.time() - start)
+        logger.info("loaded %d rows into %s with %d workers at %.0f rows/s" %
+                    (report.rows, self.table, len(workers),
+                     report.rows_per_second))
+        return report
+
+    def _chunks(self, source, format):
+        """ yields the (table, data, rows, format) of every chunk """
+        if isinstance(source, string_types):
+            with io.open(source, encoding='utf-8') as f:
+                for chunk in self._text_chunks(f, format):
+                    yield chunk
+        elif hasattr(source, 'read'):
+            for chunk in self._text_chunks(source, format):
+                yield chunk
+        elif (hasattr(source, 'dtypes') or hasattr(source, 'column_names') or
+                hasattr(source, 'items')):
+            columns = bulk.frame_columns(source)
+            table = "%s (%s)" % (self.table, bulk.column_list(columns))
+            total = len(columns[0][1]) if columns else 0
+            for offset in range(0, total, self.chunk_rows):
+                yield (table, bulk.csv_rows(columns, offset,
+                                            offset + self.chunk_rows),
+                       min(self.chunk_rows, total - offset), 'csv')
+        else:
+            rows = []
+            for row in source:
+                rows.append(",".join(bulk.csv_value(v) for v in row) + "\n")
+                if len(rows) >= self.chunk_rows:
+                    yield self.table, "".join(rows), len(rows), 'csv'
+                    rows = []
+            if rows:
+                yield self.table, "".join(rows), len(rows), 'csv'
+
+    def _text_chunks(self, lines, format):
+        """ cuts the lines in chunks of records, a quoted csv field can hold
+        line breaks so a csv record can span lines """
+        chunk = []
+        records = 0
+        quoted = False
+        for line in lines:
+            chunk.append(line)
+            if format == 'csv':
+                quoted = _in_quotes(line, quoted)
+                if quoted:
+                    continue
+            records += 1
+            if records >= self.chunk_rows:
+                yield self.table, "".join(chunk), records, format
+                chunk = []
+                records = 0
+        if quoted:
+            raise ProgrammingError("unterminated quoted field in csv input")
+        if chunk:
+            yield self.table, "".join(chunk), records, format
+
+
+def _in_quotes(line, quoted):
+    """ whether a csv record is in a quoted field after line, given whether
+    it was before it. Quotes are escaped with a backslash or doubled. """
+    if '"' not in line:
+        return quoted
+    if '\\' not in line:
+        return quoted != (line.count('"') % 2 == 1)
+    escaped = False
+    for char in line:
+        if escaped:
+            escaped = False
+        elif char == '\\' and quoted:
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+    return quoted
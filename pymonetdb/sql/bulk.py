@@ -0,0 +1,284 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+"""
+functions for converting columns of data to the formats used by the
+MonetDB bulk loading statements.
+"""
+
+import binascii
+import datetime
+import decimal
+import numbers
+from collections import namedtuple
+
+from six import text_type, string_types, binary_type as bytes_type
+
+from pymonetdb.sql import types
+from pymonetdb.exceptions import ProgrammingError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# decimals wider than this are loaded as DOUBLE
+MAX_DECIMAL_PRECISION = 38
+
+
+class LoadReport(namedtuple('LoadReport', ('rows', 'seconds'))):
+    """The number of rows loaded by a bulk load and the time it took"""
+    __slots__ = ()
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return float(self.rows)
+        return self.rows / self.seconds
+
+
+# numpy dtype (kind, itemsize) to the MonetDB type with the same
+# binary representation
+binary_types = {
+    ('b', 1): types.BOOLEAN,
+    ('i', 1): types.TINYINT,
+    ('i', 2): types.SMALLINT,
+    ('i', 4): types.INT,
+    ('i', 8): types.BIGINT,
+    ('f', 4): types.REAL,
+    ('f', 8): types.DOUBLE,
+}
+
+# the nil value of the binary format for each dtype kind, floats use NaN
+binary_nils = {
+    'b': 0x80,
+    'i': None,  # the minimum of the integer type
+    'f': float('nan'),
+}
+
+STRING_NIL = b"\x80"
+
+
+def binary_type(array):
+    """
+    Return the MonetDB type of the binary representation of a numpy array
+    """
+    kind = array.dtype.kind
+    if kind in 'OUS':
+        return types.CLOB
+    try:
+        return binary_types[(kind, array.dtype.itemsize)]
+    except KeyError:
+        raise ProgrammingError("dtype %s not supported for binary "
+                               "loading" % array.dtype)
+
+
+def binary_column(array):
+    """
+    Return an iterable of bytes-like objects holding the numpy array in the
+    little endian MonetDB binary COPY format. Fixed width columns are
+    returned as a view on the array data without converting the values,
+    masked values become nil.
+    """
+    if numpy is None:
+        raise ProgrammingError("binary loading requires numpy")
+
+    if binary_type(array) == types.CLOB:
+        return [_binary_strings(array)]
+
+    kind = array.dtype.kind
+    if kind == 'b':
+        array = array.view(numpy.uint8)
+    if isinstance(array, numpy.ma.MaskedArray):
+        nil = binary_nils[kind]
+        if nil is None:
+            nil = numpy.iinfo(array.dtype).min
+        array = array.filled(nil)
+    array = numpy.ascontiguousarray(array.ravel(),
+                                    dtype=array.dtype.newbyteorder('<'))
+    return [memoryview(array.view(numpy.uint8))]
+
+
+def _binary_strings(array):
+    """ zero terminated utf-8 strings, None and masked values become nil """
+    if isinstance(array, numpy.ma.MaskedArray):
+        array = array.astype(object).filled(None)
+    parts = []
+    for value in array.ravel().tolist():
+        if value is None:
+            parts.append(STRING_NIL)
+        elif isinstance(value, text_type):
+            parts.append(value.encode('utf-8'))
+        else:
+            parts.append(value)
+        parts.append(b"\0")
+    return b"".join(parts)
+
+
+def is_null(value):
+    """ True for None and the NaN and NaT values used as missing values """
+    try:
+        return value is None or bool(value != value)
+    except (TypeError, ValueError):
+        # pandas.NA doesn't compare to anything
+        return True
+
+
+def frame_columns(frame):
+    """
+    Return the columns of a data frame as a list of (name, values) pairs.
+    Supports pandas DataFrames, Arrow tables and mappings of names to
+    sequences or arrays.
+    """
+    if hasattr(frame, 'dtypes') and hasattr(frame, 'columns'):
+        # pandas
+        return [(str(name), frame[name].values) for name in frame.columns]
+    if hasattr(frame, 'column_names') and hasattr(frame, 'to_pandas'):
+        # arrow
+        return [(name, frame.column(i).to_pandas().values)
+                for (i, name) in enumerate(frame.column_names)]
+    if hasattr(frame, 'items'):
+        return list(frame.items())
+    raise ProgrammingError("unsupported frame type %s" % type(frame))
+
+
+def column_type(values):
+    """
+    Return the SQL type for a column, as used in CREATE TABLE. Uses the
+    dtype of numpy arrays, for object columns the type is inferred from the
+    values, including the width of VARCHAR and the precision and scale of
+    DECIMAL columns.
+    """
+    dtype = getattr(values, 'dtype', None)
+    if dtype is not None and dtype.kind in 'biuf':
+        if dtype.kind == 'u':
+            # no unsigned types, use the next wider signed type
+            if dtype.itemsize >= 8:
+                return types.DECIMAL.upper() + "(20, 0)"
+            return binary_types[('i', dtype.itemsize * 2)].upper()
+        try:
+            return binary_types[(dtype.kind, dtype.itemsize)].upper()
+        except KeyError:
+            raise ProgrammingError("dtype %s not supported" % dtype)
+    if dtype is not None and dtype.kind == 'M':
+        return types.TIMESTAMP.upper()
+    if hasattr(values, 'tolist'):
+        values = values.tolist()
+
+    present = [v for v in values if not is_null(v)]
+    if not present:
+        return types.VARCHAR.upper() + "(1)"
+    if all(isinstance(v, bool) for v in present):
+        return types.BOOLEAN.upper()
+    if all(isinstance(v, numbers.Integral) for v in present):
+        return types.BIGINT.upper()
+    if all(isinstance(v, decimal.Decimal) for v in present):
+        return _decimal_type(present)
+    if all(isinstance(v, numbers.Real) for v in present):
+        return types.DOUBLE.upper()
+    if all(isinstance(v, datetime.datetime) for v in present):
+        return types.TIMESTAMP.upper()
+    if all(isinstance(v, datetime.date) for v in present):
+        return types.DATE.upper()
+    if all(isinstance(v, datetime.time) for v in present):
+        return types.TIME.upper()
+    if all(isinstance(v, bytes_type) and not isinstance(v, string_types)
+           for v in present):
+        return types.BLOB.upper()
+    width = max(len(text_type(v)) for v in present)
+    return "%s(%d)" % (types.VARCHAR.upper(), max(width, 1))
+
+
+def _decimal_type(values):
+    integer_digits = scale = 0
+    for value in values:
+        _, digits, exponent = value.as_tuple()
+        if not isinstance(exponent, int):
+            # NaN or infinity
+            return types.DOUBLE.upper()
+        scale = max(scale, -exponent)
+        integer_digits = max(integer_digits, len(digits) + exponent)
+    precision = max(integer_digits + scale, 1)
+    if precision > MAX_DECIMAL_PRECISION:
+        return types.DOUBLE.upper()
+    return "%s(%d, %d)" % (types.DECIMAL.upper(), precision, scale)
+
+
+def quote_identifier(name):
+    """
+    Return a column name as a delimited SQL identifier, so names that are
+    reserved words or hold spaces can be used. Its case is kept.
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+def column_list(columns):
+    """
+    Return the quoted names of a list of (name, values) pairs, as used in
+    the column list of COPY INTO
+    """
+    return ", ".join(quote_identifier(name) for (name, _) in columns)
+
+
+def create_table_statement(table, columns, if_not_exists=False):
+    """
+    Return the CREATE TABLE statement for a list of (name, values) pairs
+    """
+    definitions = ", ".join("%s %s" % (quote_identifier(name),
+                                       column_type(values))
+                            for (name, values) in columns)
+    return "CREATE TABLE %s%s (%s)" % ("IF NOT EXISTS " if if_not_exists else "",
+                                       table, definitions)
+
+
+def csv_value(value):
+    """
+    Return a value formatted for COPY FROM with the 'csv' format, NULL, NaN
+    and NaT become the empty string
+    """
+    if is_null(value):
+        return ""
+    if isinstance(value, bool):
+        return ["false", "true"][value]
+    if isinstance(value, (numbers.Number, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return str(value)
+    if isinstance(value, bytes_type) and not isinstance(value, string_types):
+        # BLOB columns take hex
+        return binascii.hexlify(value).decode('ascii')
+    value = text_type(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '"%s"' % value
+
+
+def csv_rows(columns, start=0, stop=None):
+    """
+    Return the rows start to stop of a list of (name, values) pairs as text
+    in the 'csv' COPY format
+    """
+    values = []
+    for (_, column) in columns:
+        column = column[start:stop]
+        if getattr(column, 'dtype', None) is not None and column.dtype.kind == 'M':
+            # datetime64[ns] values become ints, microseconds datetimes
+            column = column.astype('datetime64[us]')
+        if hasattr(column, 'tolist'):
+            column = column.tolist()
+        values.append([csv_value(v) for v in column])
+    return "".join(",".join(row) + "\n" for row in zip(*values))
+
+
+def supports_binary(columns):
+    """ True if all columns are numpy arrays that can be loaded in the
+    binary format """
+    if numpy is None:
+        return False
+    for (_, values) in columns:
+        dtype = getattr(values, 'dtype', None)
+        if dtype is None or (dtype.kind, dtype.itemsize) not in binary_types:
+            return False
+    return True
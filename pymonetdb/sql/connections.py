@@ -4,23 +4,45 @@
 #
 # Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
 
+import itertools
 import logging
+import os
 import platform
+import random
+import threading
+import time
+from collections import OrderedDict
 
-from pymonetdb.sql import cursors
+from six import string_types
+
+from pymonetdb.sql import cursors, bulk
 from pymonetdb import exceptions
 from pymonetdb import mapi
 
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport
+    futures = None
+
 logger = logging.getLogger("pymonetdb")
 
 
+def is_conflict(error):
+    """ True if error tells the transaction was aborted because it
+    conflicted with a concurrent transaction """
+    return 'concurrency conflict' in str(error)
+
+
 class Connection(object):
     """A MonetDB SQL database connection"""
     default_cursor = cursors.Cursor
 
     def __init__(self, database, hostname=None, port=50000, username="monetdb",
                  password="monetdb", unix_socket=None, autocommit=False,
-                 host=None, user=None, connect_timeout=-1):
+                 host=None, user=None, connect_timeout=-1,
+                 file_transfer=False, lazy=False, on_fork='reconnect',
+                 decode_processes=0):
         """ Set up a connection to a MonetDB SQL database.
 
         args:
@@ -34,6 +56,17 @@ class Connection(object):
             autocommit (bool):  enable/disable auto commit (default: False)
             connect_timeout -- the socket timeout while connecting
                                (default: see python socket module)
+            file_transfer (bool): negotiate the file transfer protocol used
+                                  by COPY ... ON CLIENT (default: False)
+            lazy (bool): don't connect before the connection is first used,
+                         connection errors are raised then (default: False)
+            on_fork (str): what a process forked from the one that connected
+                           does when using the connection, 'reconnect' to
+                           make its own connection or 'raise' to raise an
+                           InterfaceError (default: 'reconnect')
+            decode_processes (int): the number of processes converting the
+                                    rows of large results, 0 to convert
+                                    them in the calling process (default: 0)
 
         returns:
             Connection object
@@ -49,19 +82,91 @@ class Connection(object):
         if platform.system() == "Windows" and not hostname:
             hostname = "localhost"
 
+        self.autocommit = autocommit
+        self.sizeheader = True
+        self.replysize = 100
+
+        # session setting commands not yet sent to the server, they are
+        # pipelined with the next command
+        self._deferred = OrderedDict()
+
+        # the Transaction of the current transaction() block
+        self._transaction = None
+
+        # counters of run_transaction()
+        self.transaction_conflicts = 0
+        self.transaction_retries = 0
+
+        # serialises the commands of threads sharing the connection, a
+        # transaction() block however spans the statements of all threads
+        self.lock = threading.RLock()
+
+        # the socket timeout to set once connected
+        self._timeout = None
+
+        if on_fork not in ('reconnect', 'raise'):
+            raise exceptions.ProgrammingError("on_fork should be 'reconnect' "
+                                              "or 'raise', not %s" % on_fork)
+        self.on_fork = on_fork
+        # the process that made the connection, a forked child shares the
+        # socket and must never send anything on it
+        self._pid = None
+
+        self.decode_processes = decode_processes
+        # made on first use, see decode_pool()
+        self._decode_pool = None
+
         self.mapi = mapi.Connection()
-        self.mapi.connect(hostname=hostname, port=int(port), username=username,
-                          password=password, database=database, language="sql",
-                          unix_socket=unix_socket, connect_timeout=connect_timeout)
-        self.set_autocommit(autocommit)
-        self.set_sizeheader(True)
+        self.mapi.file_transfer = file_transfer
+        self._connect_args = dict(hostname=hostname, port=int(port),
+                                  username=username, password=password,
+                                  database=database, language="sql",
+                                  unix_socket=unix_socket,
+                                  connect_timeout=connect_timeout)
+        if not lazy:
+            self._connect()
 
-        self.set_replysize(100)
+    @mapi.locked
+    def _connect(self):
+        """ connect to the server and set up the session """
+        handshake_options = [
+            mapi.HandshakeOption(1, "auto_commit", self.autocommit,
+                                 "Xauto_commit %d" % self.autocommit),
+            mapi.HandshakeOption(2, "reply_size", self.replysize,
+                                 "Xreply_size %d" % self.replysize),
+            mapi.HandshakeOption(3, "size_header", self.sizeheader,
+                                 "Xsizeheader %d" % self.sizeheader),
+        ]
+        # the handshake carries the current reply size
+        self._deferred.pop('reply_size', None)
 
-        self.autocommit = autocommit
-        self.sizeheader = True
-        self.replysize = None
+        self.mapi.connect(handshake_options=handshake_options,
+                          **self._connect_args)
+        self._pid = os.getpid()
+        if self._timeout is not None:
+            self.mapi.socket.settimeout(self._timeout)
 
+        # set the options the server didn't accept during login in one go
+        self._commands([option.command for option in handshake_options
+                        if not option.sent])
+
+    def _connected(self):
+        return self.mapi is not None and self.mapi.state == mapi.STATE_READY
+
+    def _abandon(self):
+        """ drop a connection inherited from the parent process. The socket
+        is closed without sending anything, the session stays with the
+        parent """
+        inherited = self.mapi
+        self.mapi = mapi.Connection()
+        self.mapi.file_transfer = inherited.file_transfer
+        inherited.socket.close()
+        self._deferred.clear()
+        self._transaction = None
+        # the workers of the pool belong to the parent
+        self._decode_pool = None
+
+    @mapi.locked
     def close(self):
         """ Close the connection.
 
@@ -73,31 +178,85 @@ class Connection(object):
         to be performed.
         """
         if self.mapi:
-            if not self.autocommit:
-                self.rollback()
-            self.mapi.disconnect()
+            if self._connected() and self._pid != os.getpid():
+                self._abandon()
+            if self._connected():
+                if not self.autocommit:
+                    self.rollback()
+                self.mapi.disconnect()
             self.mapi = None
+            if self._decode_pool is not None:
+                self._decode_pool.shutdown(wait=False)
+                self._decode_pool = None
         else:
             raise exceptions.Error("already closed")
 
+    def decode_pool(self):
+        """
+        Return the process pool converting the rows of large results, None
+        if decode_processes is 0. The pool is started on first use.
+        """
+        if not self.decode_processes:
+            return None
+        if self._decode_pool is None:
+            if futures is None:
+                raise exceptions.ProgrammingError("decode processes require "
+                                                  "concurrent.futures, install "
+                                                  "the futures package")
+            self._decode_pool = futures.ProcessPoolExecutor(self.decode_processes)
+        return self._decode_pool
+
     def set_autocommit(self, autocommit):
         """
         Set auto commit on or off. 'autocommit' must be a boolean
         """
-        self.command("Xauto_commit %s" % int(autocommit))
-        self.autocommit = autocommit
+        if autocommit != self.autocommit:
+            if self._connected():
+                self.command("Xauto_commit %s" % int(autocommit))
+            self.autocommit = autocommit
 
     def set_sizeheader(self, sizeheader):
         """
         Set sizeheader on or off. When enabled monetdb will return
         the size a type. 'sizeheader' must be a boolean.
         """
-        self.command("Xsizeheader %s" % int(sizeheader))
-        self.sizeheader = sizeheader
+        if sizeheader != self.sizeheader:
+            if self._connected():
+                self.command("Xsizeheader %s" % int(sizeheader))
+            self.sizeheader = sizeheader
+
+    def set_replysize(self, replysize, defer=False):
+        """
+        Set the number of rows the server sends in the first window of a
+        result set. If defer is set the setting is sent along with the
+        next command instead of in a round trip of its own.
+        """
+        if replysize != self.replysize:
+            command = "Xreply_size %s" % int(replysize)
+            if defer:
+                self._deferred['reply_size'] = command
+            else:
+                self._deferred.pop('reply_size', None)
+                if self._connected():
+                    self.command(command)
+            self.replysize = replysize
+
+    def _take_deferred(self):
+        """ returns and forgets the deferred session setting commands """
+        commands = list(self._deferred.values())
+        self._deferred.clear()
+        return commands
 
-    def set_replysize(self, replysize):
-        self.command("Xreply_size %s" % int(replysize))
-        self.replysize = replysize
+    @mapi.locked
+    def _commands(self, commands):
+        """ send low level mapi commands in one pipelined burst, raises the
+        first error """
+        if not commands:
+            return
+        self.__mapi_check()
+        for result in self.mapi.pipeline(commands):
+            if result.error:
+                raise result.error
 
     def commit(self):
         """
@@ -110,7 +269,7 @@ class Connection(object):
         implement this method with void functionality.
         """
         self.__mapi_check()
-        return self.cursor().execute('COMMIT')
+        self.execute('COMMIT')
 
     def rollback(self):
         """
@@ -124,7 +283,116 @@ class Connection(object):
         rollback to be performed.
         """
         self.__mapi_check()
-        return self.cursor().execute('ROLLBACK')
+        self.execute('ROLLBACK')
+
+    def transaction(self):
+        """
+        Return a context manager running the statements executed in its
+        block as one transaction. It commits when the block ends and rolls
+        back if it raises.
+
+        In auto commit mode START TRANSACTION is sent in the same block as
+        the first statement. A transaction started that way that only read
+        data can't fail to commit, its COMMIT is sent along with the next
+        command on the connection, so short read-only transactions take a
+        single round trip. Without auto commit a transaction is always
+        pending, it is committed at the end of the block, including the
+        statements executed before it.
+
+        The transaction belongs to the connection, not to the thread that
+        opened the block. While a thread is in a block, statements on the
+        connection from other threads and blocks they try to open raise
+        ProgrammingError, give every thread its own connection instead.
+        """
+        return Transaction(self)
+
+    def run_transaction(self, fn, retries=5, backoff=0.05, max_backoff=2.0):
+        """
+        Call fn(connection) in a transaction block and return its result.
+        MonetDB aborts transactions that conflict with a concurrent one,
+        on such a conflict the transaction is rolled back and fn is called
+        again. Before every retry it sleeps a random time up to backoff
+        seconds, doubling with every attempt up to max_backoff, so the
+        conflicting writers don't collide again.
+
+        The conflicts and retries are counted in the transaction_conflicts
+        and transaction_retries attributes.
+
+        args:
+            fn: the callable running the statements of the transaction
+            retries (int): how often fn is retried before the conflict
+                           error is raised
+            backoff (float): the initial maximal delay in seconds
+            max_backoff (float): the maximal delay in seconds
+
+        returns:
+            the return value of fn
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.transaction():
+                    return fn(self)
+            except exceptions.DatabaseError as e:
+                if not is_conflict(e):
+                    raise
+                self.transaction_conflicts += 1
+                if attempt >= retries:
+                    raise
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            logger.info("transaction conflict, retrying in %.3f s" % delay)
+            time.sleep(delay)
+            attempt += 1
+            self.transaction_retries += 1
+
+    def write_frame(self, frame, table, if_exists='append', chunk_size=100000):
+        """
+        Write a data frame to a table, creating the table if it doesn't
+        exist. The column types are inferred from the frame. The rows are
+        loaded in chunks, in the binary format if all columns are fixed
+        width numpy arrays and the connection negotiated file transfers,
+        otherwise with COPY FROM STDIN.
+
+        args:
+            frame: a pandas DataFrame, an Arrow table or a mapping of column
+                   names to sequences
+            table (str): name of the table
+            if_exists (str): 'append' to add the rows to an existing table,
+                             'replace' to drop and recreate it
+            chunk_size (int): the number of rows loaded per statement
+
+        returns:
+            a bulk.LoadReport with the number of rows and the time it took
+        """
+        if if_exists not in ('append', 'replace'):
+            raise exceptions.ProgrammingError("if_exists should be 'append' or "
+                                              "'replace', not %s" % if_exists)
+        start = time.time()
+        columns = bulk.frame_columns(frame)
+        if not columns:
+            raise exceptions.ProgrammingError("frame has no columns")
+        total = len(columns[0][1])
+
+        cursor = self.cursor()
+        if if_exists == 'replace':
+            cursor.execute("DROP TABLE IF EXISTS %s" % table)
+        cursor.execute(bulk.create_table_statement(table, columns,
+                                                   if_not_exists=True))
+
+        binary = self.mapi.file_transfer and bulk.supports_binary(columns)
+        for offset in range(0, total, chunk_size):
+            if binary:
+                cursor.insert_columns(table, [(name, values[offset:offset + chunk_size])
+                                              for (name, values) in columns])
+            else:
+                data = bulk.csv_rows(columns, offset, offset + chunk_size)
+                cursor.copy_from("%s (%s)" % (table, bulk.column_list(columns)), data,
+                                 rows=min(chunk_size, total - offset))
+
+        report = bulk.LoadReport(total, time.time() - start)
+        logger.info("loaded %d rows into %s at %.0f rows/s" %
+                    (report.rows, table, report.rows_per_second))
+        return report
 
     def cursor(self):
         """
@@ -135,28 +403,183 @@ class Connection(object):
         """
         return cursors.Cursor(self)
 
-    def execute(self, query):
+    def execute(self, query, raw=False):
         """ use this for executing SQL queries """
-        return self.command('s' + query + '\n;')
+        return self.command('s' + query + '\n;', raw)
 
-    def command(self, command):
-        """ use this function to send low level mapi commands """
+    @mapi.locked
+    def execute_stream(self, chunks, raw=False):
+        """ execute a SQL query given as an iterable of str or bytes
+        fragments. The fragments are sent while they are produced, so a
+        generated statement is never held in memory as a whole. Returns the
+        response like execute(). """
         self.__mapi_check()
-        return self.mapi.cmd(command)
+        self._commands(self._take_deferred())
+        prefix, starts = self._begin_query('s')
+        response = self.mapi.cmd_chunks(itertools.chain([prefix], chunks,
+                                                        ['\n;']), raw)
+        return self._end_query(prefix, response, starts)
+
+    @mapi.locked
+    def execute_stream_into(self, query, write):
+        """ execute a SQL query and pass the raw response to write() while
+        it is received. Returns the protocol lines trailing the data. """
+        self.__mapi_check()
+        commands = self._take_deferred()
+        transaction = self._block_transaction()
+        if transaction and not transaction.started and self.autocommit:
+            commands.append('sSTART TRANSACTION\n;')
+        self._commands(commands)
+        if transaction:
+            transaction.started = True
+        return self.mapi.cmd_stream('s' + query + '\n;', write)
+
+    @mapi.locked
+    def pipeline(self, operations, window=mapi.PIPELINE_WINDOW,
+                 raise_errors=True):
+        """ Execute many independent SQL statements in as few round trips
+        as possible. The statements are sent back to back and the
+        responses are read in order afterwards, with at most window
+        statements outstanding.
+
+        args:
+            operations: a sequence of operations, each either a str or an
+                        (operation, parameters) pair
+            window (int): the maximal number of outstanding statements
+            raise_errors (bool): raise the first error after all responses
+                                 are read. Otherwise the error is only added
+                                 to the messages of the statement's cursor.
+
+        returns:
+            a list with a cursor holding the result of each statement
+        """
+        self.__mapi_check()
+        result_cursors = []
+        queries = []
+        for operation in operations:
+            parameters = None
+            if not isinstance(operation, string_types):
+                operation, parameters = operation
+            cursor = self.cursor()
+            cursor.operation = operation
+            queries.append('s' + cursor._bind(operation, parameters) + '\n;')
+            result_cursors.append(cursor)
+
+        starts = False
+        if queries:
+            queries[0], starts = self._begin_query(queries[0])
+        deferred = self._take_deferred()
+        results = self.mapi.pipeline(deferred + queries, window)
+        for result in results[:len(deferred)]:
+            if result.error:
+                raise result.error
+
+        error = None
+        for cursor, result in zip(result_cursors, results[len(deferred):]):
+            response = result.response
+            if not result.error:
+                try:
+                    response = self._end_query(result.operation, response, starts)
+                except exceptions.Error as e:
+                    result = result._replace(error=e)
+            starts = False
+            if result.error:
+                cursor.messages.append((type(result.error), str(result.error)))
+                error = error or result.error
+            else:
+                cursor._store_result(response)
+                cursor.rownumber = 0
+                cursor._executed = cursor.operation
+        if error and raise_errors:
+            raise error
+        return result_cursors
+
+    @mapi.locked
+    def command(self, command, raw=False):
+        """ use this function to send low level mapi commands. With raw a
+        response holding result rows is returned as undecoded bytes. """
+        self.__mapi_check()
+        command, starts = self._begin_query(command)
+        deferred = self._take_deferred()
+        if not deferred:
+            response = self.mapi.cmd(command, raw)
+        else:
+            results = self.mapi.pipeline(deferred + [command])
+            for result in results:
+                if result.error:
+                    raise result.error
+            response = results[-1].response
+        return self._end_query(command, response, starts)
+
+    def _begin_query(self, command):
+        """ prepends START TRANSACTION to the first query in a transaction
+        block in auto commit mode. Returns the command and if it does. """
+        transaction = self._block_transaction()
+        if (transaction and not transaction.started and self.autocommit and
+                command.startswith('s')):
+            return 'sSTART TRANSACTION;\n' + command[1:], True
+        return command, False
+
+    def _block_transaction(self):
+        """ returns the open transaction block, which must be the one of the
+        calling thread """
+        transaction = self._transaction
+        if transaction and transaction.thread is not threading.current_thread():
+            raise exceptions.ProgrammingError(
+                "another thread is in a transaction block on this connection")
+        return transaction
+
+    def _end_query(self, command, response, starts):
+        """ strips the response to a prepended START TRANSACTION and keeps
+        track of the statements in a transaction block that write """
+        transaction = self._transaction
+        if not transaction or not command.startswith('s'):
+            return response
+        if starts:
+            transaction.started = True
+            if response.startswith(mapi.MSG_QTRANS):
+                response = self.mapi._handle_response(response.partition('\n')[2])
+        marks = ['\n' + mapi.MSG_QUPDATE, '\n' + mapi.MSG_QSCHEMA]
+        if not isinstance(response, string_types):
+            # undecoded result rows
+            marks = [mapi.encode(mark) for mark in marks]
+        if (response[:2] in (marks[0][1:], marks[1][1:]) or
+                marks[0] in response or marks[1] in response):
+            transaction.writes = True
+        return response
 
     def __mapi_check(self):
-        """ check if there is a connection with a server """
+        """ check if there is a connection with a server, connecting a
+        lazy connection """
         if not self.mapi:
             raise exceptions.Error("connection closed")
+        if self._connected() and self._pid != os.getpid():
+            if self.on_fork == 'raise':
+                raise exceptions.InterfaceError("connection made by process %d "
+                                                "used in forked process %d" %
+                                                (self._pid, os.getpid()))
+            logger.info("reconnecting in forked process %d" % os.getpid())
+            self._abandon()
+            self._connect()
+        elif self._pid is None:
+            # a lazy connection, used for the first time
+            self._connect()
+        elif not self._connected():
+            # dropped, a new session would silently lose the old one's state
+            raise exceptions.ProgrammingError("Not connected")
         return True
 
     def settimeout(self, timeout):
         """ set the amount of time before a connection times out """
-        self.mapi.socket.settimeout(timeout)
+        self._timeout = timeout
+        if self._connected():
+            self.mapi.socket.settimeout(timeout)
 
     def gettimeout(self):
         """ get the amount of time before a connection times out """
-        return self.mapi.socket.gettimeout()
+        if self._connected():
+            return self.mapi.socket.gettimeout()
+        return self._timeout
 
     # these are required by the python DBAPI
     Warning = exceptions.Warning
@@ -169,3 +592,89 @@ class Connection(object):
     InternalError = exceptions.InternalError
     ProgrammingError = exceptions.ProgrammingError
     NotSupportedError = exceptions.NotSupportedError
+
+
+class Transaction(object):
+    """Context manager for a transaction block, see Connection.transaction()"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        # START TRANSACTION was sent
+        self.started = False
+        # a statement in the block changed data or schema
+        self.writes = False
+        # the thread in the block
+        self.thread = None
+
+    def __enter__(self):
+        if self.connection._block_transaction():
+            raise exceptions.ProgrammingError("already in a transaction block")
+        self.thread = threading.current_thread()
+        self.connection._transaction = self
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.connection
+        connection._transaction = None
+        if not self.started and connection.autocommit:
+            # nothing was executed
+            return False
+        if exc_type is not None:
+            connection.rollback()
+        elif self.writes or not self.started:
+            # without auto commit the statements before the block may have
+            # written
+            connection.commit()
+        else:
+            connection._deferred['transaction'] = 'sCOMMIT\n;'
+        return False
+
+
+class ThreadLocalConnections(object):
+    """
+    Hands every thread its own connection, so threads don't wait for each
+    other's commands. The connection of a thread is made with the connect
+    arguments the first time the thread asks for it and reused afterwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = os.getpid()
+
+    def get(self):
+        """ return the connection of the calling thread """
+        if self._pid != os.getpid():
+            self._forked()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or connection.mapi is None:
+            connection = Connection(*self._args, **self._kwargs)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """ close the connections of all threads, a thread calling get()
+        afterwards gets a new connection """
+        if self._pid != os.getpid():
+            self._forked()
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            if connection.mapi is not None:
+                connection.close()
+
+    def _forked(self):
+        """ discard the connections inherited from the parent process """
+        for connection in self._connections:
+            if connection._connected():
+                connection._abandon()
+            connection.mapi = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = os.getpid()
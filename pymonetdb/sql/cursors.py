@@ -4,25 +4,121 @@
 #
 # Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
 
+import binascii
+import codecs
+import io
 import logging
+import os
+import shutil
 from collections import namedtuple
 import tempfile
 import re
 import pickle
 import pdb
 
-from pymonetdb.sql import monetize, pythonize
+from pymonetdb.sql import monetize, pythonize, bulk, storage, types
 from pymonetdb.exceptions import ProgrammingError, InterfaceError
 from pymonetdb import mapi
-from six import u, PY2
+from six import u, PY2, PY3, string_types
 
 logger = logging.getLogger("pymonetdb")
 
+# results with fewer rows in a response are decoded in the calling process
+# even when the connection has decode processes
+DECODE_MIN_ROWS = 20000
+
+# the number of rows sent to a decode process at once
+DECODE_CHUNK_ROWS = 5000
+
+# the number of bytes Cursor.fetch_lob() keeps in memory without a sink
+# before moving them to a temporary file
+LOB_SPOOL_SIZE = 1024 * 1024
+
+
+# delimiter clauses for the formats supported by COPY INTO and COPY FROM
+copy_formats = {
+    'csv': "USING DELIMITERS ',', E'\\n', '\"' NULL AS ''",
+    'tsv': "USING DELIMITERS E'\\t', E'\\n' NULL AS ''",
+}
+
 
 Description = namedtuple('Description', ('name', 'type_code', 'display_size', 'internal_size', 'precision', 'scale',
                                          'null_ok'))
 
 
+def _columns(rows, description):
+    """ the rows of a batch as a tuple per column """
+    return list(zip(*rows)) or [() for _ in description]
+
+
+class _HexWriter(object):
+    """ writes the BLOB values of COPY INTO STDOUT lines as bytes, keeping
+    a hex digit split from its pair until the next data arrives. Calls
+    on_value with the size of every value at its end. """
+
+    def __init__(self, write, on_value=None):
+        self.write = write
+        self.on_value = on_value
+        self.size = 0
+        self._value_size = 0
+        self._pending = b""
+
+    def __call__(self, data):
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end == -1:
+                self._hex(data[start:])
+                return
+            self._hex(data[start:end])
+            self._end_value()
+            start = end + 1
+
+    def _hex(self, data):
+        data = self._pending + data
+        cut = len(data) - len(data) % 2
+        self._pending = data[cut:]
+        if cut:
+            try:
+                value = binascii.unhexlify(data[:cut])
+            except (binascii.Error, TypeError):
+                raise InterfaceError("invalid hex data in BLOB value")
+            self.write(value)
+            self.size += len(value)
+            self._value_size += len(value)
+
+    def _end_value(self):
+        if self._pending:
+            raise InterfaceError("odd number of hex digits in BLOB value")
+        if self.on_value is not None:
+            self.on_value(self._value_size)
+        self._value_size = 0
+
+
+# the layouts of Cursor.fetch_batches(), making a batch from a list of rows
+batch_layouts = {
+    'rows': lambda rows, description: rows,
+    'columns': _columns,
+    'array': lambda rows, description: storage.ArrayResult(description, rows),
+    'dictionary': lambda rows, description: storage.ArrayResult(
+        description, rows, dictionary=True),
+}
+
+
+class ResultSet(object):
+    """One result set in the response to an operation"""
+
+    def __init__(self, query_id=-1, rowcount=-1, description=None,
+                 lastrowid=None, continuation=False):
+        self.query_id = query_id
+        self.rowcount = rowcount
+        self.description = description
+        self.lastrowid = lastrowid
+        self.rows = []
+        # True for a further window of an earlier result set
+        self.continuation = continuation
+
+
 class Cursor(object):
     """This object represents a database cursor, which is used to manage
     the context of a fetch operation. Cursors created from the same
@@ -87,6 +183,32 @@ class Cursor(object):
         # Only select queries have query ID
         self._query_id = -1
 
+        # the result sets following the current one, for nextset()
+        self._results = []
+
+        # when set, fetchall() and fetchmany() return a
+        # storage.SpillingResult that keeps at most this many bytes of rows
+        # in memory and the others in temporary files
+        self.spill_limit = None
+
+        # windows of rows fetched before, scroll() and fetching rows again
+        # use them instead of asking the server. Disabled until its limit
+        # is set to the number of bytes it may use.
+        self.window_cache = storage.WindowCache()
+
+        # fetch the window following the one asked for in the same round
+        # trip, and keep it in the window cache. Ignored while the cache is
+        # disabled.
+        self.prefetch = False
+
+        # decode every distinct value of a string column once and share
+        # the string between the rows of the result it is in. Applies to
+        # the rows decoded in this process, not in decode processes.
+        self.dictionary_strings = False
+
+        # the pythonize.string_dictionaries() of the result sets, by query id
+        self._dictionaries = {}
+
         # This is a Python list object to which the interface appends
         # tuples (exception class, exception value) for all messages
         # which the interfaces receives from the underlying database for
@@ -136,18 +258,6 @@ class Cursor(object):
         # clear message history
         self.messages = []
 
-        # convert to utf-8
-        if PY2:
-            if type(operation) == unicode:
-                # don't decode if it is already unicode
-                operation = operation.encode('utf-8')
-            else:
-                operation = u(operation).encode('utf-8')
-
-        # set the number of rows to fetch
-        if self.arraysize != self.connection.replysize:
-            self.connection.set_replysize(self.arraysize)
-
         if operation == self.operation:
             # same operation, DBAPI mentioned something about reuse
             # but monetdb doesn't support this
@@ -155,28 +265,38 @@ class Cursor(object):
         else:
             self.operation = operation
 
-        query = ""
-        if parameters:
-            if isinstance(parameters, dict):
-                query = operation % dict([(k, monetize.convert(v))
-                                          for (k, v) in parameters.items()])
-            elif type(parameters) == list or type(parameters) == tuple:
-                query = operation % tuple(
-                    [monetize.convert(item) for item in parameters])
-            elif isinstance(parameters, str):
-                query = operation % monetize.convert(parameters)
-            else:
-                msg = "Parameters should be None, dict or list, now it is %s"
-                self._exception_handler(ValueError, msg % type(parameters))
-        else:
-            query = operation
-
-        block = self.connection.execute(query)
+        query = self._bind(operation, parameters)
+        self.window_cache.clear()
+        self._dictionaries = {}
+        block = self.connection.execute(query, raw=True)
         self._store_result(block)
         self.rownumber = 0
         self._executed = operation
         return self.rowcount
 
+    def _bind(self, operation, parameters):
+        """ returns the operation with the parameters filled in """
+        if PY2:
+            if type(operation) == unicode:
+                # don't decode if it is already unicode
+                operation = operation.encode('utf-8')
+            else:
+                operation = u(operation).encode('utf-8')
+
+        if not parameters:
+            return operation
+        if isinstance(parameters, dict):
+            return operation % dict([(k, monetize.convert(v))
+                                     for (k, v) in parameters.items()])
+        elif type(parameters) == list or type(parameters) == tuple:
+            return operation % tuple(
+                [monetize.convert(item) for item in parameters])
+        elif isinstance(parameters, str):
+            return operation % monetize.convert(parameters)
+        else:
+            msg = "Parameters should be None, dict or list, now it is %s"
+            self._exception_handler(ValueError, msg % type(parameters))
+
     def executemany(self, operation, seq_of_parameters):
         """Prepare a database operation (query or command) and then
         execute it against all parameter sequences or mappings
@@ -191,6 +311,214 @@ class Cursor(object):
         self.rowcount = count
         return count
 
+    def copy_to(self, query, sink, format='csv'):
+        """Export the result of a query to a file or file-like object.
+
+        The query is wrapped in a COPY INTO STDOUT statement and the data as
+        formatted by the server is written to the sink as it arrives,
+        without converting the values to Python objects.
+
+        args:
+            query (str): the SELECT query to export
+            sink: a filename or an object with a write() method. Text mode
+                  file objects receive str, all others bytes.
+            format (str): one of the keys of copy_formats (default: "csv")
+
+        returns:
+            the number of exported rows, or -1 if the server didn't report it
+        """
+        if not self.connection:
+            self._exception_handler(ProgrammingError, "cursor is closed")
+
+        if format not in copy_formats:
+            msg = "unknown format '%s'" % format
+            self._exception_handler(ProgrammingError, msg)
+
+        self.messages = []
+        query = query.strip().rstrip(';')
+        operation = "COPY (%s) INTO STDOUT %s" % (query, copy_formats[format])
+
+        if isinstance(sink, string_types):
+            with open(sink, 'wb') as f:
+                self._stream_into(operation, f.write)
+        elif isinstance(sink, io.TextIOBase):
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            self._stream_into(operation,
+                              lambda data: sink.write(decoder.decode(data)))
+        else:
+            self._stream_into(operation, sink.write)
+        return self.rowcount
+
+    def _stream_into(self, operation, write):
+        """ execute a COPY INTO STDOUT operation passing the data to write(),
+        the rowcount is the number of rows the server reports """
+        trailer = self.connection.execute_stream_into(operation, write)
+        self._results = []
+        self._load_result(ResultSet())
+        if trailer.startswith(mapi.MSG_QUPDATE):
+            self.rowcount = int(trailer[2:].split()[0])
+        self._executed = operation
+
+    def fetch_lob(self, query, parameters=None, sink=None, on_value=None):
+        """Stream the BLOB values a query selects to a file, converting
+        them from hex to bytes while the response is received, so a value
+        is never held in memory as a whole.
+
+        The query must select a single BLOB column, which is checked with
+        a query for its description first. The values of all rows are
+        written one after the other, so a value stored in chunks can be
+        reassembled with an ORDER BY. To tell several values apart pass
+        on_value, or select a single row.
+
+        args:
+            query (str): the SELECT query
+            parameters: bound to the query like for execute()
+            sink: a filename or a binary file-like object with a write()
+                  method. If not given the bytes are written to a
+                  temporary file, kept in memory up to LOB_SPOOL_SIZE bytes.
+            on_value: called with the number of bytes of every value after
+                      it is written, 0 for NULL and empty values
+
+        returns:
+            the number of bytes written to the sink, or without a sink the
+            temporary file positioned at the start
+        """
+        if not self.connection:
+            self._exception_handler(ProgrammingError, "cursor is closed")
+
+        query = self._bind(query, parameters).strip().rstrip(';')
+        self.execute("SELECT * FROM (%s) AS lob LIMIT 0" % query)
+        if [column.type_code for column in self.description or []] != [types.BLOB]:
+            msg = "fetch_lob() needs a query selecting a single BLOB column"
+            self._exception_handler(ProgrammingError, msg)
+
+        self.messages = []
+        operation = "COPY (%s) INTO STDOUT %s" % (query, copy_formats['tsv'])
+
+        if sink is None:
+            spool = tempfile.SpooledTemporaryFile(LOB_SPOOL_SIZE)
+            self._stream_into(operation, _HexWriter(spool.write, on_value))
+            spool.seek(0)
+            return spool
+        if isinstance(sink, string_types):
+            with open(sink, 'wb') as f:
+                writer = _HexWriter(f.write, on_value)
+                self._stream_into(operation, writer)
+        else:
+            writer = _HexWriter(sink.write, on_value)
+            self._stream_into(operation, writer)
+        return writer.size
+
+    def copy_from(self, table, data, format='csv', rows=None):
+        """Bulk load text formatted data into an existing table with
+        COPY FROM STDIN. The data is sent in the same block as the
+        statement.
+
+        args:
+            table (str): name of the table to load into, optionally
+                         followed by a list of columns
+            data (str): the records, formatted as described by format
+            format (str): one of the keys of copy_formats (default: "csv")
+            rows (int): the number of records in data, counted if not given
+
+        returns:
+            the number of inserted rows
+        """
+        if not self.connection:
+            self._exception_handler(ProgrammingError, "cursor is closed")
+
+        if format not in copy_formats:
+            msg = "unknown format '%s'" % format
+            self._exception_handler(ProgrammingError, msg)
+
+        self.messages = []
+        if PY2 and isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if rows is None:
+            rows = data.count('\n')
+        if data and not data.endswith('\n'):
+            data += '\n'
+
+        operation = "COPY %d RECORDS INTO %s FROM STDIN %s" % (
+            rows, table, copy_formats[format])
+        block = self.connection.command('s' + operation + ';\n' + data)
+        self.operation = operation
+        self._store_result(block)
+        self.rownumber = 0
+        self._executed = operation
+        return self.rowcount
+
+    def insert_columns(self, table, columns):
+        """Bulk load numpy arrays into the columns of an existing table.
+
+        The arrays are sent in the MonetDB binary COPY format. Fixed width
+        columns are sent straight from the array buffers, without
+        converting the individual values. When the connection negotiated
+        the file transfer protocol the data is uploaded ON CLIENT,
+        otherwise it is written to temporary files which the server reads
+        ON SERVER, which only works if the server runs on this host. The
+        files are only readable by the current user, connect with
+        file_transfer=True when the server runs as another user.
+
+        args:
+            table (str): name of the table to load into
+            columns: a mapping or a sequence of (column name, array) pairs
+
+        returns:
+            the number of inserted rows
+        """
+        if not self.connection:
+            self._exception_handler(ProgrammingError, "cursor is closed")
+
+        self.messages = []
+        if hasattr(columns, 'items'):
+            columns = list(columns.items())
+        if not columns:
+            self._exception_handler(ProgrammingError, "no columns given")
+        if len(set(len(array) for (_, array) in columns)) != 1:
+            self._exception_handler(ProgrammingError, "columns differ in length")
+
+        names = bulk.column_list(columns)
+        buffers = [bulk.binary_column(array) for (_, array) in columns]
+        template = "COPY LITTLE ENDIAN BINARY INTO %s (%s) FROM %s ON %s"
+        mapi_connection = self.connection.mapi
+
+        if mapi_connection.file_transfer:
+            files = ["'%d'" % i for i in range(len(columns))]
+            operation = template % (table, names, ", ".join(files), "CLIENT")
+
+            def uploader(filename, binary, offset):
+                return buffers[int(filename)]
+
+            # the uploader is seen by every command on the connection, keep
+            # other threads out until the load is done
+            with self.connection.lock:
+                mapi_connection.uploader = uploader
+                try:
+                    block = self.connection.execute(operation)
+                finally:
+                    mapi_connection.uploader = None
+        else:
+            directory = tempfile.mkdtemp(prefix='pymonetdb')
+            try:
+                files = []
+                for i, data in enumerate(buffers):
+                    path = os.path.join(directory, str(i))
+                    with open(path, 'wb') as f:
+                        for buf in data:
+                            f.write(buf)
+                    files.append(monetize.monet_escape(path))
+                operation = template % (table, names, ", ".join(files), "SERVER")
+                block = self.connection.execute(operation)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        self.operation = operation
+        self._store_result(block)
+        self.rownumber = 0
+        self._executed = operation
+        return self.rowcount
+
     def __exportparameters(self, ftype, fname, query, quantity_parameters,
                            sample):
         """ Exports the input parameters of a given UDF execution
@@ -443,7 +771,7 @@ class Cursor(object):
             return None
 
         if self.rownumber >= (self._offset + len(self._rows)):
-            self.nextset()
+            self._next_window()
 
         result = self._rows[self.rownumber - self._offset]
         self.rownumber += 1
@@ -478,11 +806,12 @@ class Cursor(object):
             return []
 
         end = min(self.rownumber + (size or self.arraysize), self.rowcount)
-        result = self._rows[self.rownumber - self._offset:end - self._offset]
+        result = self._new_result()
+        result.extend(self._rows[self.rownumber - self._offset:end - self._offset])
         self.rownumber = min(end, len(self._rows) + self._offset)
 
-        while (end > self.rownumber) and self.nextset():
-                result += self._rows[self.rownumber - self._offset:end - self._offset]
+        while (end > self.rownumber) and self._next_window():
+                result.extend(self._rows[self.rownumber - self._offset:end - self._offset])
                 self.rownumber = min(end, len(self._rows) + self._offset)
         return result
 
@@ -502,16 +831,67 @@ class Cursor(object):
             msg = "query didn't result in a resultset"
             self._exception_handler(ProgrammingError, msg)
 
-        result = self._rows[self.rownumber - self._offset:]
+        result = self._new_result()
+        result.extend(self._rows[self.rownumber - self._offset:])
         self.rownumber = len(self._rows) + self._offset
 
         # slide the window over the resultset
-        while self.nextset():
-            result += self._rows
+        while self._next_window():
+            result.extend(self._rows[self.rownumber - self._offset:])
             self.rownumber = len(self._rows) + self._offset
 
         return result
 
+    def fetch_batches(self, size=None, layout='rows'):
+        """Return an iterator over the remaining rows of a query result
+        in batches, one for every window received from the server. A
+        batch of rows is the list the window was decoded into, not a
+        copy, so it shouldn't be modified.
+
+        args:
+            size (int): the number of rows per window asked from the
+                        server, the cursor's arraysize if not given. The
+                        first batch holds the rows received with the
+                        result.
+            layout (str): 'rows' for batches that are lists of rows,
+                          'columns' for lists with a tuple per column,
+                          'array' for a storage.ArrayResult,
+                          'dictionary' for one with dictionary encoded
+                          string columns
+
+        An Error (or subclass) exception is raised if the previous
+        call to .execute*() did not produce any result set or no
+        call was issued yet."""
+
+        self._check_executed()
+
+        if self._query_id == -1:
+            msg = "query didn't result in a resultset"
+            self._exception_handler(ProgrammingError, msg)
+
+        if layout not in batch_layouts:
+            msg = "unknown layout '%s'" % layout
+            self._exception_handler(ProgrammingError, msg)
+
+        return self._batches(size, batch_layouts[layout])
+
+    def _batches(self, size, layout):
+        while True:
+            rows = self._rows
+            if self.rownumber > self._offset:
+                rows = rows[self.rownumber - self._offset:]
+            self.rownumber = len(self._rows) + self._offset
+            if rows:
+                yield layout(rows, self.description)
+            if not self._next_window(size):
+                return
+
+    def _new_result(self):
+        """ the sequence fetched rows are collected in """
+        if self.spill_limit is None:
+            return []
+        return storage.SpillingResult(self.description, self.spill_limit)
+
     def nextset(self):
         """This method will make the cursor skip to the next
         available set, discarding any remaining rows from the
@@ -528,18 +908,52 @@ class Cursor(object):
 
         self._check_executed()
 
+        if not self._results:
+            return None
+
+        self._load_result(self._results.pop(0))
+        return True
+
+    def _next_window(self, size=None):
+        """Fetch the window of rows following the current one from the
+        server, of size rows or else arraysize. Returns False if there are
+        no more rows."""
+
         if self.rownumber >= self.rowcount:
             return False
 
-        self._offset += len(self._rows)
-
-        end = min(self.rowcount, self.rownumber + self.arraysize)
-        amount = end - self._offset
+        self._load_window(self._offset + len(self._rows), size)
+        return True
 
-        command = 'Xexport %s %s %s' % (self._query_id, self._offset, amount)
-        block = self.connection.command(command)
+    def _load_window(self, position, size=None):
+        """ make a window holding the row at position the current one, from
+        the window cache or else from the server """
+        cached = self.window_cache.find(self._query_id, position)
+        if cached:
+            self._offset, self._rows = cached
+            return
+
+        size = size or self.arraysize
+        amount = min(self.rowcount - position, size)
+        count = amount
+        if self.prefetch and self.window_cache.limit:
+            # the next window is only kept if the cache is enabled
+            count = min(self.rowcount - position, 2 * size)
+
+        # the result pages, larger first windows would have saved this
+        # round trip. The setting is sent along with the Xexport.
+        if size > self.connection.replysize:
+            self.connection.set_replysize(size, defer=True)
+
+        command = 'Xexport %s %s %s' % (self._query_id, position, count)
+        block = self.connection.command(command, raw=True)
         self._store_result(block)
-        return True
+        self._offset = position
+        if len(self._rows) > amount:
+            self.window_cache.put(self._query_id, position + amount,
+                                  self._rows[amount:])
+            self._rows = self._rows[:amount]
+        self.window_cache.put(self._query_id, position, self._rows)
 
     def setinputsizes(self, sizes):
         """
@@ -569,29 +983,68 @@ class Cursor(object):
         return self.next()
 
     def _store_result(self, block):
-        """ parses the mapi result into a resultset"""
+        """ parses the mapi result into result sets. A response to a query
+        positions the cursor on the first of its result sets, a response
+        to Xexport replaces the rows of the current result set"""
+
+        results = self._parse_block(block) or [ResultSet()]
+        if results[0].continuation:
+            self._rows = results[0].rows
+        else:
+            self._results = results[1:]
+            self._load_result(results[0])
+
+    def _load_result(self, result):
+        """ make result the current result set of the cursor """
+        self._query_id = result.query_id
+        self.rowcount = result.rowcount
+        self.description = result.description
+        self.lastrowid = result.lastrowid
+        self._rows = result.rows
+        self._offset = 0
+        self.rownumber = 0
+        if result.query_id != -1:
+            self.window_cache.put(result.query_id, 0, result.rows)
+
+    def _parse_block(self, block):
+        """ parses a mapi response into a list of ResultSet, one for every
+        result header in it """
 
         if not block:
             block = ""
 
+        results = []
+        result = None
+        # the tuple lines of every result set, by index in results
+        tuple_lines = {}
         columns = 0
         column_name = ""
         scale = display_size = internal_size = precision = 0
         null_ok = False
         type_ = []
+        line = ""
+
+        # result rows arrive undecoded, only the other lines are decoded,
+        # the fields of the rows when they are converted
+        raw = PY3 and isinstance(block, bytes)
+        for line in block.split(b"\n" if raw else "\n"):
+            if raw:
+                if line.startswith(b"["):
+                    tuple_lines.setdefault(len(results) - 1, []).append(line)
+                    continue
+                line = line.decode('utf-8')
 
-        for line in block.split("\n"):
             if line.startswith(mapi.MSG_INFO):
                 logger.info(line[1:])
                 self.messages.append((Warning, line[1:]))
 
             elif line.startswith(mapi.MSG_QTABLE):
-                self._query_id, rowcount, columns, tuples = line[2:].split()[:4]
+                query_id, rowcount, columns, tuples = line[2:].split()[:4]
 
                 columns = int(columns)   # number of columns in result
-                self.rowcount = int(rowcount)  # total number of rows
                 # tuples = int(tuples)     # number of rows in this set
-                self._rows = []
+                result = ResultSet(query_id=int(query_id), rowcount=int(rowcount))
+                results.append(result)
 
                 # set up fields for description
                 # table_name = [None] * columns
@@ -604,9 +1057,6 @@ class Cursor(object):
                 null_ok = [None] * columns
                 # typesizes = [(0, 0)] * columns
 
-                self._offset = 0
-                self.lastrowid = None
-
             elif line.startswith(mapi.MSG_HEADER):
                 (data, identity) = line[1:].split("#")
                 values = [x.strip() for x in data.split(",")]
@@ -636,62 +1086,70 @@ class Cursor(object):
                 for i in range(columns):
                     description.append(Description(column_name[i], type_[i], display_size[i], internal_size[i],
                                                    precision[i], scale[i], null_ok[i]))
-                self.description = description
-                self._offset = 0
-                self.lastrowid = None
+                result.description = description
 
             elif line.startswith(mapi.MSG_TUPLE):
-                values = self._parse_tuple(line)
-                self._rows.append(values)
+                tuple_lines.setdefault(len(results) - 1, []).append(line)
 
             elif line.startswith(mapi.MSG_TUPLE_NOSLICE):
-                self._rows.append((line[1:],))
+                result.rows.append((line[1:],))
 
             elif line.startswith(mapi.MSG_QBLOCK):
-                self._rows = []
+                # the next window of the current result set
+                result = ResultSet(query_id=self._query_id, rowcount=self.rowcount,
+                                   description=self.description, continuation=True)
+                results.append(result)
 
             elif line.startswith(mapi.MSG_QSCHEMA):
-                self._offset = 0
-                self.lastrowid = None
-                self._rows = []
-                self.description = None
-                self.rowcount = -1
+                results.append(ResultSet())
 
             elif line.startswith(mapi.MSG_QUPDATE):
                 (affected, identity) = line[2:].split()[:2]
-                self._offset = 0
-                self._rows = []
-                self.description = None
-                self.rowcount = int(affected)
-                self.lastrowid = int(identity)
-                self._query_id = -1
+                results.append(ResultSet(rowcount=int(affected),
+                                         lastrowid=int(identity)))
 
             elif line.startswith(mapi.MSG_QTRANS):
-                self._offset = 0
-                self.lastrowid = None
-                self._rows = []
-                self.description = None
-                self.rowcount = -1
-
-            elif line == mapi.MSG_PROMPT:
-                return
+                results.append(ResultSet())
 
             elif line.startswith(mapi.MSG_ERROR):
                 self._exception_handler(ProgrammingError, line[1:])
 
-        self._exception_handler(InterfaceError, "Unknown state, %s" % block)
-
-    def _parse_tuple(self, line):
-        """
-        parses a mapi data tuple, and returns a list of python types
-        """
-        elements = line[1:-1].split(',\t')
-        if len(elements) == len(self.description):
-            return tuple([pythonize.convert(element.strip(), description[1])
-                          for (element, description) in zip(elements,
-                                                            self.description)])
-        else:
-            self._exception_handler(InterfaceError, "length of row doesn't match header")
+        if line != mapi.MSG_PROMPT:
+            self._exception_handler(InterfaceError, "Unknown state, %s" % block)
+
+        for (index, lines) in tuple_lines.items():
+            result = results[index]
+            result.rows.extend(self._decode_tuples(lines, result.description,
+                                                   result.query_id))
+        return results
+
+    def _decode_tuples(self, lines, description, query_id):
+        """ converts the tuple lines of a result set, in the decode process
+        pool of the connection when there are many of them """
+        pool = None
+        if len(lines) >= DECODE_MIN_ROWS:
+            pool = self.connection.decode_pool()
+
+        type_codes = [column[1] for column in description]
+        rows = []
+        try:
+            if pool is None:
+                dictionaries = None
+                if self.dictionary_strings:
+                    if query_id not in self._dictionaries:
+                        self._dictionaries[query_id] = \
+                            pythonize.string_dictionaries(type_codes)
+                    dictionaries = self._dictionaries[query_id]
+                return pythonize.convert_tuples(lines, type_codes, dictionaries)
+            separator = b"\n" if PY3 and isinstance(lines[0], bytes) else "\n"
+            chunks = [separator.join(lines[i:i + DECODE_CHUNK_ROWS])
+                      for i in range(0, len(lines), DECODE_CHUNK_ROWS)]
+            for chunk_rows in pool.map(pythonize.decode_tuples, chunks,
+                                       [type_codes] * len(chunks)):
+                rows.extend(chunk_rows)
+        except InterfaceError as e:
+            self._exception_handler(InterfaceError, str(e))
+        return rows
 
     def scroll(self, value, mode='relative'):
         """
@@ -714,15 +1172,13 @@ class Cursor(object):
         if mode == 'relative':
             value += self.rownumber
 
-        if value > self.rowcount:
+        if value < 0 or value > self.rowcount:
             self._exception_handler(IndexError, "value beyond length of resultset")
 
-        self._offset = value
-        end = min(self.rowcount, self.rownumber + self.arraysize)
-        amount = end - self._offset
-        command = 'Xexport %s %s %s' % (self._query_id, self._offset, amount)
-        block = self.connection.command(command)
-        self._store_result(block)
+        self.rownumber = value
+        if (value < self.rowcount and
+                not self._offset <= value < self._offset + len(self._rows)):
+            self._load_window(value)
 
     def _exception_handler(self, exception_class, message):
         """
@@ -16,10 +16,15 @@ import uuid
 from decimal import Decimal
 
 from pymonetdb.sql import types
-from pymonetdb.exceptions import ProgrammingError
+from pymonetdb.exceptions import ProgrammingError, InterfaceError
 from six import PY3
 
 
+# the number of distinct values kept in the dictionary of a string column,
+# the values of columns with more aren't shared beyond that
+DICTIONARY_LIMIT = 100000
+
+
 def _extract_timezone(data):
     sign_symbol = data[-6]
 
@@ -146,6 +151,123 @@ def convert(data, type_code):
         raise ProgrammingError("type %s is not supported" % type_code)
 
 
+def _decimal_bytes(data):
+    return Decimal(data.decode('ascii'))
+
+
+# the types converted by a builtin that accepts the surrounding whitespace
+# of a field, their fields never contain the field separator
+numeric_types = dict((type_code, function) for (type_code, function)
+                     in mapping.items() if function in (int, float, Decimal))
+
+# the same for fields received as bytes, int() and float() parse them
+# without decoding
+numeric_bytes_types = dict((type_code, _decimal_bytes if function is Decimal
+                            else function)
+                           for (type_code, function) in numeric_types.items())
+
+
+def convert_bytes(data, type_code):
+    """
+    Like convert() for a field received as bytes. Only fields that aren't
+    numbers are decoded.
+    """
+    if data == b"NULL":
+        return None
+    function = numeric_bytes_types.get(type_code)
+    if function is not None:
+        return function(data)
+    return convert(data.decode('utf-8'), type_code)
+
+
+def _is_bytes(line):
+    return PY3 and isinstance(line, bytes)
+
+
+def _convert_column(fields, function, null):
+    try:
+        return list(map(function, fields))
+    except (ValueError, ArithmeticError):
+        # there are NULL values
+        return [None if field.strip() == null else function(field)
+                for field in fields]
+
+
+def convert_tuples(lines, type_codes, dictionaries=None):
+    """
+    Converts mapi tuple lines, str or bytes, to a list of tuples. When all
+    columns are numeric the lines are split in one go and every column is
+    converted with a single map() over its fields. dictionaries are the
+    string_dictionaries() of the columns, kept over several calls to share
+    the strings of all rows of a result.
+    """
+    if not lines or not all(t in numeric_types for t in type_codes):
+        return [parse_tuple(line, type_codes, dictionaries) for line in lines]
+
+    if _is_bytes(lines[0]):
+        separator, null, functions = b',\t', b"NULL", numeric_bytes_types
+    else:
+        separator, null, functions = ',\t', "NULL", numeric_types
+    count = len(type_codes)
+    fields = separator.join([line[1:-1] for line in lines]).split(separator)
+    if len(fields) != len(lines) * count:
+        raise InterfaceError("length of row doesn't match header")
+    columns = [_convert_column(fields[i::count], functions[type_code], null)
+               for (i, type_code) in enumerate(type_codes)]
+    return list(zip(*columns))
+
+
+def string_dictionaries(type_codes):
+    """
+    A dictionary for every string column and None for the other columns,
+    for convert_tuples() to decode every distinct value of a column once
+    and share the string between the rows it is in
+    """
+    return [{} if mapping.get(type_code) is strip else None
+            for type_code in type_codes]
+
+
+def _lookup(data, type_code, function, dictionary):
+    if dictionary is None:
+        return function(data, type_code)
+    try:
+        return dictionary[data]
+    except KeyError:
+        value = function(data, type_code)
+        if len(dictionary) < DICTIONARY_LIMIT:
+            dictionary[data] = value
+        return value
+
+
+def parse_tuple(line, type_codes, dictionaries=None):
+    """
+    Converts a mapi tuple line, str or bytes, to a tuple of python values.
+    The fields of columns with a dictionary are looked up in it first.
+    """
+    if _is_bytes(line):
+        elements, function = line[1:-1].split(b',\t'), convert_bytes
+    else:
+        elements, function = line[1:-1].split(',\t'), convert
+    if len(elements) != len(type_codes):
+        raise InterfaceError("length of row doesn't match header")
+    if dictionaries is None:
+        return tuple([function(element.strip(), type_code)
+                      for (element, type_code) in zip(elements, type_codes)])
+    return tuple([_lookup(element.strip(), type_code, function, dictionary)
+                  for (element, type_code, dictionary)
+                  in zip(elements, type_codes, dictionaries)])
+
+
+def decode_tuples(text, type_codes):
+    """
+    Converts newline separated mapi tuple lines to a list of tuples. This
+    is what decoding worker processes run, so it only takes picklable
+    arguments.
+    """
+    return convert_tuples(text.split(b'\n' if _is_bytes(text) else '\n'),
+                          type_codes)
+
+
 # below stuff required by the DBAPI
 
 def Binary(data):
@@ -0,0 +1,506 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+"""
+storage for the rows of results bigger than the memory they may use
+"""
+
+import mmap
+import pickle
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+from pymonetdb.sql import types, pythonize
+from pymonetdb.exceptions import ProgrammingError
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# the number of bytes the rows of a SpillingResult may use in memory
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# the number of rows used to estimate the memory a row uses
+SAMPLE_ROWS = 100
+
+# a fixed width column record is a null flag and the value
+fixed_formats = {
+    types.TINYINT: '<Bq',
+    types.SMALLINT: '<Bq',
+    types.INT: '<Bq',
+    types.BIGINT: '<Bq',
+    types.SERIAL: '<Bq',
+    types.SHORTINT: '<Bq',
+    types.MEDIUMINT: '<Bq',
+    types.LONGINT: '<Bq',
+    types.WRD: '<Bq',
+    types.REAL: '<Bd',
+    types.FLOAT: '<Bd',
+    types.DOUBLE: '<Bd',
+    types.BOOLEAN: '<B?',
+}
+
+# the values of other columns are pickled in the heap, the column record
+# is their offset and length in the heap, None has length -1
+HEAP_FORMAT = '<Bqq'
+
+
+def _size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def estimate_size(rows):
+    """ the number of bytes a list of rows uses, estimated from a sample """
+    if not rows:
+        return sys.getsizeof(rows)
+    sample = rows[:SAMPLE_ROWS]
+    return (sys.getsizeof(rows) +
+            int(sum(_size(row) for row in sample) * len(rows) / float(len(sample))))
+
+
+class WindowCache(object):
+    """
+    The most recently used windows of result rows, keyed by query id and the
+    position of their first row, using at most limit bytes. A limit of 0
+    disables the cache.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        # (query_id, offset) to (rows, size), least recently used first
+        self._windows = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._windows)
+
+    def put(self, query_id, offset, rows):
+        """ add a window, evicting the least recently used ones """
+        if not self.limit or not rows:
+            return
+        size = estimate_size(rows)
+        if size > self.limit:
+            return
+        key = (query_id, offset)
+        if key in self._windows:
+            self._size -= self._windows.pop(key)[1]
+        self._windows[key] = (rows, size)
+        self._size += size
+        while self._size > self.limit:
+            _, (_, evicted) = self._windows.popitem(last=False)
+            self._size -= evicted
+
+    def find(self, query_id, position):
+        """ the (offset, rows) of a window holding the row at position, or
+        None """
+        for (key, (rows, size)) in self._windows.items():
+            if key[0] == query_id and key[1] <= position < key[1] + len(rows):
+                # now the most recently used
+                del self._windows[key]
+                self._windows[key] = (rows, size)
+                return key[1], rows
+        return None
+
+    def clear(self):
+        self._windows.clear()
+        self._size = 0
+
+
+class SpillingResult(object):
+    """
+    A sequence of result rows that moves the rows to temporary files once
+    they use more memory than allowed. Every time the limit is reached the
+    rows in memory are written as a page, in a column file with fixed width
+    records and a heap for strings and other variable width values. The
+    files are memory mapped, so any row can be read without reading the
+    rows before it.
+
+    Supports len(), indexing, slicing and iteration. close() removes the
+    files.
+    """
+
+    def __init__(self, description, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.description = description
+        self.memory_limit = memory_limit
+        type_codes = [column[1] for column in description or []]
+        self._formats = [struct.Struct(fixed_formats.get(t, HEAP_FORMAT))
+                         for t in type_codes]
+        self._heaped = [t not in fixed_formats for t in type_codes]
+        # the rows not written to a page yet
+        self._rows = []
+        self._row_size = None
+        # the first row and the column offsets of every page
+        self._starts = []
+        self._offsets = []
+        self._spilled = 0
+        self._data = None
+        self._heap = None
+        self._data_map = None
+        self._heap_map = None
+
+    @property
+    def spilled(self):
+        """ the number of rows written to disk """
+        return self._spilled
+
+    def __len__(self):
+        return self._spilled + len(self._rows)
+
+    def extend(self, rows):
+        """ add rows at the end """
+        self._rows.extend(rows)
+        if self._row_size is None and self._rows:
+            sample = self._rows[:SAMPLE_ROWS]
+            self._row_size = sum(_size(row) for row in sample) / float(len(sample))
+        if self._row_size and len(self._rows) * self._row_size > self.memory_limit:
+            self._spill()
+
+    def append(self, row):
+        self.extend([row])
+
+    def _spill(self):
+        """ write the rows in memory as a page """
+        if self._data is None:
+            self._data = tempfile.TemporaryFile(prefix='pymonetdb')
+            self._heap = tempfile.TemporaryFile(prefix='pymonetdb')
+        self._unmap()
+
+        self._data.seek(0, 2)
+        self._heap.seek(0, 2)
+        heap_offset = self._heap.tell()
+        offsets = []
+        columns = zip(*self._rows) if self._rows else []
+        for (values, fmt, heaped) in zip(columns, self._formats, self._heaped):
+            offsets.append(self._data.tell())
+            records = []
+            for value in values:
+                if value is None:
+                    records.append(fmt.pack(1, 0, -1) if heaped else fmt.pack(1, 0))
+                elif heaped:
+                    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                    self._heap.write(data)
+                    records.append(fmt.pack(0, heap_offset, len(data)))
+                    heap_offset += len(data)
+                else:
+                    records.append(fmt.pack(0, value))
+            self._data.write(b"".join(records))
+
+        self._starts.append(self._spilled)
+        self._offsets.append(offsets)
+        self._spilled += len(self._rows)
+        self._rows = []
+
+    def _unmap(self):
+        for mapped in (self._data_map, self._heap_map):
+            if mapped is not None:
+                mapped.close()
+        self._data_map = self._heap_map = None
+
+    def _map(self):
+        if self._data_map is None:
+            self._data.flush()
+            self._heap.flush()
+            self._data_map = mmap.mmap(self._data.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            if self._heap.tell():
+                self._heap_map = mmap.mmap(self._heap.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+
+    def _row(self, index):
+        if index >= self._spilled:
+            return self._rows[index - self._spilled]
+        self._map()
+        page = bisect_right(self._starts, index) - 1
+        position = index - self._starts[page]
+        row = []
+        for (offset, fmt, heaped) in zip(self._offsets[page], self._formats,
+                                         self._heaped):
+            record = fmt.unpack_from(self._data_map, offset + position * fmt.size)
+            if record[0]:
+                row.append(None)
+            elif heaped:
+                start, length = record[1:]
+                row.append(pickle.loads(self._heap_map[start:start + length]))
+            else:
+                row.append(record[1])
+        return tuple(row)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._row(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._row(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._row(index)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def close(self):
+        """ remove the temporary files """
+        self._unmap()
+        for f in (self._data, self._heap):
+            if f is not None:
+                f.close()
+        self._data = self._heap = None
+        self._rows = []
+        self._starts = []
+        self._offsets = []
+        self._spilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# the array type code of 64 bit integers
+try:
+    array('q')
+    INT64 = 'q'
+except ValueError:
+    # python 2 has no long long arrays
+    INT64 = 'l'
+
+# the array type code of the fixed width columns of an ArrayResult
+array_types = dict((type_code, {'q': INT64, 'd': 'd', '?': 'b'}[fmt[-1]])
+                   for (type_code, fmt) in fixed_formats.items())
+
+
+class _ArrayColumn(object):
+    """ fixed width values in an array, with a null mask once there are
+    NULL values """
+
+    def __init__(self, typecode):
+        self.values = array(typecode)
+        self.nulls = None
+        self._bool = typecode == 'b'
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, values):
+        start = len(self.values)
+        try:
+            self.values.extend(values)
+        except TypeError:
+            # there are NULL values
+            del self.values[start:]
+            if self.nulls is None:
+                self.nulls = bytearray(start)
+            for value in values:
+                self.nulls.append(value is None)
+                self.values.append(0 if value is None else value)
+        else:
+            if self.nulls is not None:
+                self.nulls.extend(bytearray(len(self.values) - start))
+
+    def __getitem__(self, index):
+        if self.nulls is not None and self.nulls[index]:
+            return None
+        if self._bool:
+            return bool(self.values[index])
+        return self.values[index]
+
+
+class _TextColumn(object):
+    """ strings as one utf-8 buffer and the end offset of every string """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array(INT64)
+        self.nulls = None
+
+    def __len__(self):
+        return len(self.ends)
+
+    def extend(self, values):
+        for value in values:
+            if value is None:
+                if self.nulls is None:
+                    self.nulls = bytearray(len(self.ends))
+                self.nulls.append(1)
+            else:
+                self.data.extend(value.encode('utf-8'))
+                if self.nulls is not None:
+                    self.nulls.append(0)
+            self.ends.append(len(self.data))
+
+    def __getitem__(self, index):
+        if self.nulls is not None and self.nulls[index]:
+            return None
+        start = self.ends[index - 1] if index else 0
+        return self.data[start:self.ends[index]].decode('utf-8')
+
+
+class _DictionaryColumn(object):
+    """ strings as the code of the string in a dictionary of the distinct
+    values, -1 for NULL """
+
+    def __init__(self):
+        self.codes = array('i')
+        self.values = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def extend(self, values):
+        index = self._index
+        for value in values:
+            if value is None:
+                self.codes.append(-1)
+                continue
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(self.values)
+                self.values.append(value)
+            self.codes.append(code)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        return None if code == -1 else self.values[code]
+
+
+class _ListColumn(list):
+    """ the values of other types, as they are """
+
+
+def _column(type_code, dictionary):
+    if type_code in array_types:
+        return _ArrayColumn(array_types[type_code])
+    if pythonize.mapping.get(type_code) is pythonize.strip:
+        return _DictionaryColumn() if dictionary else _TextColumn()
+    return _ListColumn()
+
+
+class ArrayRow(object):
+    """ a row of an ArrayResult, reading its values from the columns """
+    __slots__ = ('_result', '_index')
+
+    def __init__(self, result, index):
+        self._result = result
+        self._index = index
+
+    def __len__(self):
+        return len(self._result.columns)
+
+    def __getitem__(self, column):
+        if isinstance(column, slice):
+            return tuple(self)[column]
+        return self._result.columns[column][self._index]
+
+    def __iter__(self):
+        for column in self._result.columns:
+            yield column[self._index]
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class ArrayResult(object):
+    """
+    Result rows stored a column at a time. Integer, floating point and
+    boolean columns are arrays of machine values, string columns a single
+    utf-8 buffer with the offsets of the strings, other columns a list of
+    their values. Indexing returns a lightweight ArrayRow view.
+
+    With dictionary set string columns are dictionary encoded instead, an
+    array with a code per row and a list of the distinct strings, for
+    columns with few distinct values. categorical() and
+    dictionary_array() return them as a pandas Categorical or an Arrow
+    DictionaryArray without decoding every row.
+    """
+
+    def __init__(self, description, rows=None, dictionary=False):
+        self.description = description
+        self.columns = [_column(column[1], dictionary)
+                        for column in description or []]
+        self._length = 0
+        if rows:
+            self.extend(rows)
+
+    def extend(self, rows):
+        """ add rows at the end """
+        for (column, values) in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        self._length += len(rows)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ArrayRow(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return ArrayRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield ArrayRow(self, index)
+
+    def _position(self, key):
+        if isinstance(key, int):
+            return key
+        return [column[0] for column in self.description].index(key)
+
+    def column(self, key):
+        """ the values of a column, by position or name """
+        column = self.columns[self._position(key)]
+        return [column[i] for i in range(len(column))]
+
+    def _dictionary_column(self, key):
+        column = self.columns[self._position(key)]
+        if not isinstance(column, _DictionaryColumn):
+            raise ProgrammingError("column %s isn't dictionary encoded" % key)
+        return column
+
+    def categorical(self, key):
+        """ a dictionary encoded column as a pandas Categorical """
+        if pandas is None:
+            raise ProgrammingError("categorical() requires pandas")
+        column = self._dictionary_column(key)
+        return pandas.Categorical.from_codes(column.codes.tolist(),
+                                             column.values)
+
+    def dictionary_array(self, key):
+        """ a dictionary encoded column as an Arrow DictionaryArray """
+        if pyarrow is None:
+            raise ProgrammingError("dictionary_array() requires pyarrow")
+        column = self._dictionary_column(key)
+        codes = pyarrow.array([None if code == -1 else code
+                               for code in column.codes], pyarrow.int32())
+        return pyarrow.DictionaryArray.from_arrays(
+            codes, pyarrow.array(column.values, pyarrow.string()))
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import datetime
+import decimal
+import struct
+import unittest
+from six import PY2
+from pymonetdb.sql import bulk, types
+from pymonetdb.exceptions import ProgrammingError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "numpy not installed")
+class TestBinaryColumn(unittest.TestCase):
+    def encode(self, array):
+        return b''.join(bytes(b) for b in bulk.binary_column(array))
+
+    def test_types(self):
+        self.assertEqual(bulk.binary_type(numpy.zeros(1, dtype='i8')), types.BIGINT)
+        self.assertEqual(bulk.binary_type(numpy.zeros(1, dtype='f4')), types.REAL)
+        self.assertEqual(bulk.binary_type(numpy.array(['a'])), types.CLOB)
+        self.assertRaises(ProgrammingError, bulk.binary_type, numpy.zeros(1, dtype='c16'))
+
+    def test_int_little_endian(self):
+        array = numpy.array([1, -2], dtype='>i4')
+        self.assertEqual(self.encode(array), struct.pack('<ii', 1, -2))
+
+    def test_zero_copy(self):
+        array = numpy.arange(10, dtype='<f8')
+        view = bulk.binary_column(array)[0]
+        array[0] = 42.0
+        self.assertEqual(struct.unpack_from('<d', view)[0], 42.0)
+
+    def test_masked(self):
+        array = numpy.ma.masked_array([1, 2], mask=[False, True], dtype='i2')
+        self.assertEqual(self.encode(array), struct.pack('<hh', 1, -32768))
+        array = numpy.ma.masked_array([True, False], mask=[False, True])
+        self.assertEqual(self.encode(array), b'\x01\x80')
+
+    def test_strings(self):
+        array = numpy.array([u'a', None, u'é'], dtype=object)
+        self.assertEqual(self.encode(array), b'a\x00\x80\x00\xc3\xa9\x00')
+
+
+class TestFrames(unittest.TestCase):
+    def test_column_type(self):
+        self.assertEqual(bulk.column_type([1, None, 3]), 'BIGINT')
+        self.assertEqual(bulk.column_type([1.5, float('nan')]), 'DOUBLE')
+        self.assertEqual(bulk.column_type([True, False]), 'BOOLEAN')
+        self.assertEqual(bulk.column_type([u'ab', u'abcd', None]), 'VARCHAR(4)')
+        self.assertEqual(bulk.column_type([None]), 'VARCHAR(1)')
+        self.assertEqual(bulk.column_type([datetime.date(2016, 1, 1)]), 'DATE')
+        self.assertEqual(bulk.column_type([datetime.datetime(2016, 1, 1)]), 'TIMESTAMP')
+
+    def test_decimal_type(self):
+        values = [decimal.Decimal('123.4'), decimal.Decimal('-0.05'), None]
+        self.assertEqual(bulk.column_type(values), 'DECIMAL(5, 2)')
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_numpy_column_type(self):
+        self.assertEqual(bulk.column_type(numpy.zeros(2, dtype='i2')), 'SMALLINT')
+        self.assertEqual(bulk.column_type(numpy.zeros(2, dtype='u4')), 'BIGINT')
+        self.assertEqual(bulk.column_type(numpy.zeros(2, dtype='f8')), 'DOUBLE')
+        self.assertRaises(ProgrammingError, bulk.column_type, numpy.zeros(2, dtype='f2'))
+
+    def test_create_table(self):
+        columns = bulk.frame_columns({'a': [1, 2]})
+        self.assertEqual(bulk.create_table_statement('t', columns, if_not_exists=True),
+                         'CREATE TABLE IF NOT EXISTS t ("a" BIGINT)')
+
+    def test_quoted_names(self):
+        columns = [('select', [1]), ('my "b"', [u'x'])]
+        self.assertEqual(bulk.create_table_statement('t', columns),
+                         'CREATE TABLE t ("select" BIGINT, "my ""b""" VARCHAR(1))')
+        self.assertEqual(bulk.column_list(columns), '"select", "my ""b"""')
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_datetime64_rows(self):
+        values = numpy.array(['2020-01-01T10:00:00', 'NaT'], dtype='datetime64[ns]')
+        self.assertEqual(bulk.column_type(values), 'TIMESTAMP')
+        self.assertEqual(bulk.csv_rows([('a', values)]), '2020-01-01 10:00:00\n\n')
+
+    def test_csv_rows(self):
+        columns = [('a', [1, None, 3]), ('b', [u'x"y', u'', None]), ('c', [True, False, None])]
+        self.assertEqual(bulk.csv_rows(columns),
+                         '1,"x\\"y",true\n,"",false\n3,,\n')
+        self.assertEqual(bulk.csv_rows(columns, 1, 2), ',"",false\n')
+
+    @unittest.skipIf(PY2, "bytes are text on Python 2")
+    def test_csv_blob_rows(self):
+        columns = [('a', [b'\x00\x01', b'\xff', None])]
+        self.assertEqual(bulk.column_type(columns[0][1]), 'BLOB')
+        self.assertEqual(bulk.csv_rows(columns), '0001\nff\n\n')
+
+    def test_load_report(self):
+        report = bulk.LoadReport(100, 2.0)
+        self.assertEqual(report.rows_per_second, 50.0)
@@ -19,7 +19,7 @@ import tempfile
 
 from pymonetdb.exceptions import ProgrammingError
 import pymonetdb.sql
-from six import unichr, PY2
+from six import unichr, PY2, BytesIO
 
 MAPIPORT = int(os.environ.get('MAPIPORT', 50000))
 TSTDB = os.environ.get('TSTDB', 'demo')
@@ -393,7 +393,31 @@ class DatabaseTest(unittest.TestCase):
         self.cursor.execute('select * from %s; select * from %s;' %
                             (table1, table2))
         result = self.cursor.fetchall()
+        self.assertEqual(result, [(100,)])
+        self.assertTrue(self.cursor.nextset())
+        result = self.cursor.fetchall()
         self.assertEqual(result, [(50, 50)])
+        self.assertIsNone(self.cursor.nextset())
+
+    def test_copy_to(self):
+        self.create_table(('a int', 'b varchar(10)'))
+        self.cursor.execute("insert into %s VALUES (1, 'one'), (2, NULL)" % self.table)
+        sink = BytesIO()
+        rows = self.cursor.copy_to('select * from %s order by a' % self.table, sink)
+        self.assertEqual(sink.getvalue(), b'1,"one"\n2,\n')
+        self.assertEqual(rows, 2)
+
+    def test_fetch_lob(self):
+        self.create_table(('a int', 'b blob'))
+        self.cursor.execute("insert into %s VALUES (1, '0001FF'), (2, NULL), "
+                            "(3, 'AB')" % self.table)
+        sink = BytesIO()
+        size = self.cursor.fetch_lob('select b from %s order by a' % self.table,
+                                     sink=sink)
+        self.assertEqual(sink.getvalue(), b'\x00\x01\xff\xab')
+        self.assertEqual(size, 4)
+        self.assertRaises(ProgrammingError, self.cursor.fetch_lob,
+                          'select a from %s' % self.table, sink=BytesIO())
 
     def test_debug_udf(self):
         self.cursor.execute("""
@@ -0,0 +1,351 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import threading
+import time
+import unittest
+from mock import patch, Mock
+from collections import OrderedDict
+import pymonetdb
+from pymonetdb import mapi
+
+
+class FakeServer(object):
+    """Records the blocks sent to it and answers them with a response
+       chosen by the first matching prefix of the statement"""
+    def __init__(self):
+        self.sent = []
+        self.round_trips = 0
+        self.answers = OrderedDict()
+
+    def respond(self, block):
+        for prefix, response in self.answers.items():
+            if block.startswith(prefix):
+                return response
+        if block.startswith('sSTART TRANSACTION;\n'):
+            return '&4 f\n' + self.respond('s' + block[20:])
+        if block.startswith('s'):
+            return '&3\n'
+        return ''
+
+
+def fake_connection(server, autocommit=True):
+    """A connection talking to a FakeServer"""
+    def connect(mapi_connection, handshake_options, **kwargs):
+        mapi_connection.state = mapi.STATE_READY
+        for option in handshake_options:
+            option.sent = True
+
+    with patch.object(mapi.Connection, 'connect', connect):
+        connection = pymonetdb.Connection(database='demo', autocommit=autocommit)
+    mapi_connection = connection.mapi
+    blocks = []
+
+    def putblock(block):
+        server.sent.append(block)
+        blocks.append(block)
+
+    def getblock():
+        return server.respond(blocks.pop(0))
+
+    def cmd(operation, raw=False):
+        server.round_trips += 1
+        putblock(operation)
+        return mapi_connection._handle_response(getblock())
+
+    def pipeline(operations, window=mapi.PIPELINE_WINDOW):
+        server.round_trips += 1
+        results = []
+        for operation in operations:
+            putblock(operation)
+            try:
+                response = mapi_connection._handle_response(getblock())
+                results.append(mapi.PipelineResult(operation, response, None))
+            except pymonetdb.Error as e:
+                results.append(mapi.PipelineResult(operation, None, e))
+        return results
+
+    def cmd_chunks(chunks, raw=False):
+        return cmd(''.join(chunk if isinstance(chunk, str) else chunk.decode('utf-8')
+                           for chunk in chunks), raw)
+
+    mapi_connection.cmd = cmd
+    mapi_connection.cmd_chunks = cmd_chunks
+    mapi_connection.pipeline = pipeline
+    return connection
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.server.answers['sINSERT'] = '&2 1 -1\n'
+        self.server.answers['sSELECT'] = '&1 0 0 1 0\n% t # table_name\n% a # name\n% int # type\n% 1 # length\n'
+        self.connection = fake_connection(self.server)
+
+    def test_read_only_single_round_trip(self):
+        with self.connection.transaction():
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.rowcount, 0)
+            self.assertEqual(cursor.description[0].name, 'a')
+        self.assertEqual(self.server.sent, ['sSTART TRANSACTION;\nSELECT 1\n;'])
+        self.assertEqual(self.server.round_trips, 1)
+        # the commit goes along with the next command
+        self.connection.cursor().execute('SELECT 2')
+        self.assertEqual(self.server.sent[1:], ['sCOMMIT\n;', 'sSELECT 2\n;'])
+        self.assertEqual(self.server.round_trips, 2)
+
+    def test_writes_commit_at_exit(self):
+        with self.connection.transaction():
+            cursor = self.connection.cursor()
+            cursor.execute('INSERT INTO t VALUES (1)')
+            self.assertEqual(cursor.rowcount, 1)
+        self.assertEqual(self.server.sent, ['sSTART TRANSACTION;\nINSERT INTO t VALUES (1)\n;',
+                                            'sCOMMIT\n;'])
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.connection.transaction():
+                self.connection.cursor().execute('INSERT INTO t VALUES (1)')
+                raise ValueError()
+        self.assertEqual(self.server.sent[-1], 'sROLLBACK\n;')
+
+    def test_empty_block(self):
+        with self.connection.transaction():
+            pass
+        self.assertEqual(self.server.sent, [])
+
+    def test_no_autocommit(self):
+        connection = fake_connection(self.server, autocommit=False)
+        with connection.transaction():
+            connection.cursor().execute('INSERT INTO t VALUES (1)')
+        self.assertEqual(self.server.sent, ['sINSERT INTO t VALUES (1)\n;', 'sCOMMIT\n;'])
+
+    def test_execute_stream(self):
+        with self.connection.transaction():
+            response = self.connection.execute_stream(
+                ['INSERT INTO t VALUES ', b'(1)', ', (2)'])
+            self.assertEqual(response, '&2 1 -1\n')
+        self.assertEqual(self.server.sent,
+                         ['sSTART TRANSACTION;\nINSERT INTO t VALUES (1), (2)\n;',
+                          'sCOMMIT\n;'])
+
+    def test_read_only_commits_earlier_writes(self):
+        connection = fake_connection(self.server, autocommit=False)
+        connection.cursor().execute('INSERT INTO t VALUES (1)')
+        with connection.transaction():
+            connection.cursor().execute('SELECT 1')
+        self.assertEqual(self.server.sent, ['sINSERT INTO t VALUES (1)\n;',
+                                            'sSELECT 1\n;', 'sCOMMIT\n;'])
+        self.assertFalse(connection._deferred)
+
+    def test_nested(self):
+        with self.connection.transaction():
+            self.assertRaises(pymonetdb.ProgrammingError,
+                              self.connection.transaction().__enter__)
+
+    def test_other_thread(self):
+        errors = []
+
+        def other():
+            for fn in (self.connection.transaction().__enter__,
+                       lambda: self.connection.execute('SELECT 1')):
+                try:
+                    fn()
+                except pymonetdb.ProgrammingError as e:
+                    errors.append(str(e))
+
+        with self.connection.transaction():
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIn('another thread', errors[0])
+        self.assertEqual(self.server.sent, [])
+
+
+class RunTransactionTest(unittest.TestCase):
+    conflict = '!40000!COMMIT: transaction is aborted because of concurrency conflicts, will ROLLBACK instead\n'
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.server.answers['sINSERT'] = '&2 1 -1\n'
+        self.connection = fake_connection(self.server)
+
+    def insert(self, connection):
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO t VALUES (1)')
+        return cursor.rowcount
+
+    @patch('time.sleep')
+    def test_retry_on_conflict(self, sleep):
+        self.server.answers['sCOMMIT'] = self.conflict
+        calls = []
+
+        def fn(connection):
+            calls.append(1)
+            if len(calls) == 3:
+                del self.server.answers['sCOMMIT']
+            return self.insert(connection)
+
+        self.assertEqual(self.connection.run_transaction(fn, backoff=0.1), 1)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.connection.transaction_conflicts, 2)
+        self.assertEqual(self.connection.transaction_retries, 2)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 0.1)
+        self.assertTrue(0 <= delays[1] <= 0.2)
+
+    @patch('time.sleep')
+    def test_give_up(self, sleep):
+        self.server.answers['sCOMMIT'] = self.conflict
+        self.assertRaises(pymonetdb.IntegrityError, self.connection.run_transaction,
+                          self.insert, retries=2)
+        self.assertEqual(self.connection.transaction_conflicts, 3)
+        self.assertEqual(self.connection.transaction_retries, 2)
+
+    def test_other_errors_not_retried(self):
+        self.server.answers['sINSERT'] = '!M0M29!INSERT INTO: UNIQUE constraint violated\n'
+        self.assertRaises(pymonetdb.IntegrityError, self.connection.run_transaction,
+                          self.insert)
+        self.assertEqual(self.connection.transaction_conflicts, 0)
+
+
+class LazyConnectionTest(unittest.TestCase):
+    def connect(self, **kwargs):
+        return pymonetdb.connect(database='demo', lazy=True, **kwargs)
+
+    @patch('pymonetdb.mapi.Connection.connect')
+    def test_no_connect_before_use(self, connect):
+        connection = self.connect()
+        connection.set_autocommit(False)
+        connection.settimeout(5)
+        self.assertFalse(connect.called)
+        self.assertEqual(connection.gettimeout(), 5)
+        connection.close()
+        self.assertFalse(connect.called)
+
+    @patch('pymonetdb.mapi.Connection.connect')
+    def test_connect_on_first_use(self, connect):
+        connection = self.connect(autocommit=True)
+        connection.set_autocommit(False)
+
+        def ready(**kwargs):
+            connection.mapi.state = mapi.STATE_READY
+            for option in kwargs['handshake_options']:
+                option.sent = True
+        connect.side_effect = ready
+        connection.mapi.cmd = lambda operation, raw=False: '&3\n'
+
+        connection.execute('INSERT INTO t VALUES (1)')
+        self.assertEqual(connect.call_count, 1)
+        options = dict((option.name, option.value)
+                       for option in connect.call_args[1]['handshake_options'])
+        self.assertEqual(options['auto_commit'], False)
+        self.assertEqual(connect.call_args[1]['database'], 'demo')
+
+    def test_no_reconnect_after_disconnect(self):
+        connection = fake_connection(FakeServer())
+        connection.mapi.socket = Mock()
+        connection.mapi.disconnect()
+        with patch.object(connection, '_connect') as connect:
+            self.assertRaises(pymonetdb.ProgrammingError,
+                              connection.execute, 'SELECT 1')
+        self.assertFalse(connect.called)
+
+    @patch('pymonetdb.mapi.Connection.connect')
+    def test_error_on_first_use(self, connect):
+        connect.side_effect = pymonetdb.OperationalError("no server")
+        connection = self.connect()
+        self.assertRaises(pymonetdb.OperationalError,
+                          connection.execute, 'SELECT 1')
+
+
+class ThreadSafetyTest(unittest.TestCase):
+    def test_commands_serialised(self):
+        con = mapi.Connection()
+        con.state = mapi.STATE_READY
+        sent = []
+
+        def getblock():
+            # give the other threads the chance to put their commands
+            time.sleep(0.001)
+            return '=OK ' + sent.pop(0)
+        con._putblock = sent.append
+        con._getblock = getblock
+
+        errors = []
+
+        def run(name):
+            for i in range(20):
+                operation = '%s %d' % (name, i)
+                if con.cmd(operation) != operation:
+                    errors.append(operation)
+        threads = [threading.Thread(target=run, args=(str(n),))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class ThreadLocalConnectionsTest(unittest.TestCase):
+    def test_connection_per_thread(self):
+        connections = pymonetdb.ThreadLocalConnections(database='demo',
+                                                       lazy=True)
+        mine = connections.get()
+        self.assertIs(connections.get(), mine)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(connections.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], mine)
+
+        connections.close()
+        self.assertIsNone(mine.mapi)
+        self.assertIsNot(connections.get(), mine)
+
+
+@patch('pymonetdb.sql.connections.os.getpid', lambda: -1)
+class ForkTest(unittest.TestCase):
+    """The connection is used in a process forked after connecting"""
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.connection = fake_connection(self.server)
+        self.socket = self.connection.mapi.socket = Mock()
+
+    def test_reconnect(self):
+        def connect():
+            self.connection.mapi.state = mapi.STATE_READY
+            self.connection.mapi.cmd = lambda operation, raw=False: '&3\n'
+            self.connection._pid = -1
+
+        with patch.object(self.connection, '_connect', side_effect=connect):
+            self.connection.execute('INSERT INTO t VALUES (1)')
+        self.assertTrue(self.socket.close.called)
+        self.assertEqual(self.server.sent, [])
+
+    def test_raise(self):
+        self.connection.on_fork = 'raise'
+        self.assertRaises(pymonetdb.InterfaceError,
+                          self.connection.execute, 'SELECT 1')
+        self.assertEqual(self.server.sent, [])
+
+    def test_close(self):
+        self.connection.autocommit = False
+        self.connection.close()
+        self.assertTrue(self.socket.close.called)
+        self.assertEqual(self.server.sent, [])
+
+    def test_thread_local_connections(self):
+        with patch('pymonetdb.sql.connections.os.getpid', lambda: 1):
+            connections = pymonetdb.ThreadLocalConnections(database='demo',
+                                                           lazy=True)
+            inherited = connections.get()
+        self.assertIsNot(connections.get(), inherited)
+        self.assertIsNone(inherited.mapi)
@@ -0,0 +1,313 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import datetime
+from io import BytesIO
+import unittest
+from mock import patch
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+import pymonetdb
+from pymonetdb.sql.cursors import Cursor
+
+
+def table_header(query_id, rowcount, names, types, tuples):
+    return ('&1 %d %d %d %d\n' % (query_id, rowcount, len(names), tuples) +
+            '%% %s # table_name\n' % ',\t'.join(['t'] * len(names)) +
+            '%% %s # name\n' % ',\t'.join(names) +
+            '%% %s # type\n' % ',\t'.join(types) +
+            '%% %s # length\n' % ',\t'.join(['1'] * len(names)))
+
+
+class FakeConnection(object):
+    """Answers queries with a prepared response and Xexport commands with
+       windows cut from a prepared list of tuple lines per query id"""
+    replysize = 100
+
+    def __init__(self, response, tuples=None):
+        self.response = response
+        self.tuples = tuples or {}
+        self.commands = []
+        self.settings = []
+        self.pool = None
+
+    def decode_pool(self):
+        return self.pool
+
+    def set_replysize(self, replysize, defer=False):
+        self.settings.append((replysize, defer))
+        self.replysize = replysize
+
+    def execute(self, query, raw=False):
+        return self.response
+
+    def command(self, command, raw=False):
+        self.commands.append(command)
+        _, query_id, offset, amount = command.split()
+        lines = self.tuples[int(query_id)][int(offset):int(offset) + int(amount)]
+        return '&6 %s 1 %d %s\n' % (query_id, len(lines), offset) + ''.join(lines)
+
+
+class TestMultipleResultSets(unittest.TestCase):
+    def setUp(self):
+        response = (table_header(1, 2, ['a'], ['int'], 2) + '[ 1\t]\n[ 2\t]\n' +
+                    '&2 3 -1\n' +
+                    table_header(2, 1, ['b'], ['varchar'], 1) + '[ "x"\t]\n')
+        self.cursor = Cursor(FakeConnection(response))
+
+    def test_first_result(self):
+        self.cursor.execute('select ...')
+        self.assertEqual(self.cursor.rowcount, 2)
+        self.assertEqual(self.cursor.description[0].name, 'a')
+        self.assertEqual(self.cursor.fetchall(), [(1,), (2,)])
+
+    def test_nextset(self):
+        self.cursor.execute('select ...')
+        self.assertTrue(self.cursor.nextset())
+        self.assertEqual(self.cursor.rowcount, 3)
+        self.assertIsNone(self.cursor.description)
+        self.assertTrue(self.cursor.nextset())
+        self.assertEqual(self.cursor.fetchall(), [('x',)])
+        self.assertIsNone(self.cursor.nextset())
+
+    def test_execute_discards_sets(self):
+        self.cursor.execute('select ...')
+        self.cursor.connection.response = '&2 1 -1\n'
+        self.cursor.execute('insert ...')
+        self.assertIsNone(self.cursor.nextset())
+
+
+class TestPaging(unittest.TestCase):
+    def test_paging_per_result(self):
+        tuples = {1: ['[ %d\t]\n' % i for i in range(5)],
+                  2: ['[ %d\t]\n' % (i * 10) for i in range(5)]}
+        response = (table_header(1, 5, ['a'], ['int'], 2) + ''.join(tuples[1][:2]) +
+                    table_header(2, 5, ['b'], ['int'], 2) + ''.join(tuples[2][:2]))
+        connection = FakeConnection(response, tuples)
+        cursor = Cursor(connection)
+        cursor.arraysize = 2
+        cursor.execute('select ...')
+        self.assertEqual(cursor.fetchall(), [(i,) for i in range(5)])
+        self.assertTrue(cursor.nextset())
+        self.assertEqual(cursor.fetchall(), [(i * 10,) for i in range(5)])
+        self.assertEqual(connection.commands, ['Xexport 1 2 2', 'Xexport 1 4 1',
+                                               'Xexport 2 2 2', 'Xexport 2 4 1'])
+
+    def test_no_replysize_round_trip(self):
+        tuples = {1: ['[ %d\t]\n' % i for i in range(5)]}
+        response = table_header(1, 5, ['a'], ['int'], 2) + ''.join(tuples[1][:2])
+        connection = FakeConnection(response, tuples)
+        connection.replysize = 2
+        cursor = Cursor(connection)
+        cursor.arraysize = 1
+        cursor.execute('select ...')
+        self.assertEqual(connection.settings, [])
+        cursor.arraysize = 3
+        cursor.execute('select ...')
+        self.assertEqual(cursor.fetchall(), [(i,) for i in range(5)])
+        # only once the result pages the setting is deferred to the next command
+        self.assertEqual(connection.settings, [(3, True)])
+        self.assertEqual(connection.commands, ['Xexport 1 2 3'])
+
+
+class TestDecodeProcesses(unittest.TestCase):
+    @unittest.skipIf(futures is None, "concurrent.futures not available")
+    def test_rows_in_order(self):
+        lines = ''.join('[ %d,\t"r%d"\t]\n' % (i, i) for i in range(25))
+        connection = FakeConnection(table_header(1, 25, ['a', 'b'],
+                                                 ['int', 'varchar'], 25) + lines)
+        connection.pool = futures.ProcessPoolExecutor(2)
+        self.addCleanup(connection.pool.shutdown)
+        cursor = Cursor(connection)
+        with patch('pymonetdb.sql.cursors.DECODE_MIN_ROWS', 10), \
+                patch('pymonetdb.sql.cursors.DECODE_CHUNK_ROWS', 4):
+            cursor.execute('select ...')
+        self.assertEqual(cursor.fetchall(), [(i, 'r%d' % i) for i in range(25)])
+
+    def test_small_results_inline(self):
+        connection = FakeConnection(table_header(1, 1, ['a'], ['int'], 1) +
+                                    '[ 1\t]\n')
+        connection.decode_pool = None  # would fail if called
+        cursor = Cursor(connection)
+        cursor.execute('select ...')
+        self.assertEqual(cursor.fetchall(), [(1,)])
+
+
+class TestRawResponse(unittest.TestCase):
+    def test_bytes_block(self):
+        response = (table_header(1, 2, ['a', 'b', 'c'], ['int', 'varchar', 'date'], 2) +
+                    u'[ 1,\t"\u00e9t\u00e9",\t2020-01-31\t]\n[ NULL,\tNULL,\tNULL\t]\n')
+        cursor = Cursor(FakeConnection(response.encode('utf-8')))
+        cursor.execute('select ...')
+        self.assertEqual(cursor.description[1].name, 'b')
+        self.assertEqual(cursor.fetchall(), [(1, u'\u00e9t\u00e9', datetime.date(2020, 1, 31)),
+                                             (None, None, None)])
+
+
+class TestSpilling(unittest.TestCase):
+    def test_fetchall_spills(self):
+        tuples = {1: ['[ %d,\t"%s"\t]\n' % (i, 'x' * 50) for i in range(500)]}
+        response = (table_header(1, 500, ['a', 'b'], ['int', 'varchar'], 100) +
+                    ''.join(tuples[1][:100]))
+        cursor = Cursor(FakeConnection(response, tuples))
+        cursor.arraysize = 100
+        cursor.spill_limit = 10000
+        cursor.execute('select ...')
+        rows = cursor.fetchall()
+        self.addCleanup(rows.close)
+        self.assertTrue(rows.spilled > 0)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(rows[499], (499, 'x' * 50))
+
+
+class TestWindowCache(unittest.TestCase):
+    def setUp(self):
+        tuples = {1: ['[ %d\t]\n' % i for i in range(10)]}
+        response = table_header(1, 10, ['a'], ['int'], 2) + ''.join(tuples[1][:2])
+        self.connection = FakeConnection(response, tuples)
+        self.cursor = Cursor(self.connection)
+        self.cursor.arraysize = 2
+        self.cursor.execute('select ...')
+
+    def test_scroll_without_cache(self):
+        self.cursor.scroll(5, mode='absolute')
+        self.assertEqual(self.cursor.rownumber, 5)
+        self.assertEqual(self.cursor.fetchone(), (5,))
+        self.cursor.scroll(-2)
+        self.assertEqual(self.cursor.fetchone(), (4,))
+        self.assertEqual(self.connection.commands, ['Xexport 1 5 2', 'Xexport 1 4 2'])
+        self.assertRaises(IndexError, self.cursor.scroll, -10)
+
+    def test_scroll_back_cached(self):
+        self.cursor.window_cache.limit = 10 ** 6
+        self.cursor.execute('select ...')
+        self.assertEqual(self.cursor.fetchmany(6), [(i,) for i in range(6)])
+        self.cursor.scroll(0, mode='absolute')
+        self.assertEqual(self.cursor.fetchmany(6), [(i,) for i in range(6)])
+        self.cursor.scroll(3, mode='absolute')
+        self.assertEqual(self.cursor.fetchall(), [(i,) for i in range(3, 10)])
+        self.assertEqual(self.connection.commands, ['Xexport 1 2 2', 'Xexport 1 4 2',
+                                                    'Xexport 1 6 2', 'Xexport 1 8 2'])
+
+    def test_prefetch(self):
+        self.cursor.window_cache.limit = 10 ** 6
+        self.cursor.prefetch = True
+        self.cursor.execute('select ...')
+        self.assertEqual(self.cursor.fetchall(), [(i,) for i in range(10)])
+        self.assertEqual(self.connection.commands, ['Xexport 1 2 4', 'Xexport 1 6 4'])
+
+    def test_prefetch_without_cache(self):
+        self.cursor.prefetch = True
+        self.assertEqual(self.cursor.fetchall(), [(i,) for i in range(10)])
+        self.assertEqual(self.connection.commands, ['Xexport 1 2 2', 'Xexport 1 4 2',
+                                                    'Xexport 1 6 2', 'Xexport 1 8 2'])
+
+
+class TestDictionaryStrings(unittest.TestCase):
+    def test_strings_shared(self):
+        tuples = {1: ['[ %d,\t"%s"\t]\n' % (i, ['nl', 'de', 'nl'][i % 3])
+                      for i in range(6)]}
+        tuples[1][4] = '[ 4,\tNULL\t]\n'
+        response = (table_header(1, 6, ['a', 'b'], ['int', 'varchar'], 3) +
+                    ''.join(tuples[1][:3]))
+        cursor = Cursor(FakeConnection(response, tuples))
+        cursor.dictionary_strings = True
+        cursor.arraysize = 3
+        cursor.execute('select ...')
+        rows = cursor.fetchall()
+        self.assertEqual([row[1] for row in rows],
+                         ['nl', 'de', 'nl', 'nl', None, 'nl'])
+        self.assertIs(rows[0][1], rows[5][1])
+
+
+class TestFetchLob(unittest.TestCase):
+    def setUp(self):
+        self.connection = FakeConnection(table_header(1, 0, ['data'], ['blob'], 0))
+        self.operations = []
+
+        def execute_stream_into(operation, write):
+            self.operations.append(operation)
+            for packet in [b'000102', b'\n03F', b'F\n\nAB\n']:
+                write(packet)
+            return '&2 3 -1'
+        self.connection.execute_stream_into = execute_stream_into
+        self.cursor = Cursor(self.connection)
+
+    def test_sink(self):
+        sink = BytesIO()
+        size = self.cursor.fetch_lob('select data from docs where id = %s;',
+                                     (1,), sink=sink)
+        self.assertEqual(sink.getvalue(), b'\x00\x01\x02\x03\xff\xab')
+        self.assertEqual(size, 6)
+        self.assertEqual(self.cursor.rowcount, 3)
+        self.assertTrue(self.operations[0].startswith(
+            'COPY (select data from docs where id = 1) INTO STDOUT'))
+
+    def test_value_sizes(self):
+        sizes = []
+        self.cursor.fetch_lob('select data from docs', sink=BytesIO(),
+                              on_value=sizes.append)
+        self.assertEqual(sizes, [3, 2, 0, 1])
+
+    def test_spooled(self):
+        f = self.cursor.fetch_lob('select data from docs')
+        self.assertEqual(f.read(), b'\x00\x01\x02\x03\xff\xab')
+
+    def test_not_blob(self):
+        self.connection.response = table_header(1, 0, ['id'], ['int'], 0)
+        self.assertRaises(pymonetdb.ProgrammingError, self.cursor.fetch_lob,
+                          'select id from docs', sink=BytesIO())
+        self.assertEqual(self.operations, [])
+        self.connection.response = table_header(1, 0, ['a', 'b'], ['blob', 'blob'], 0)
+        self.assertRaises(pymonetdb.ProgrammingError, self.cursor.fetch_lob,
+                          'select a, b from docs', sink=BytesIO())
+
+    def test_invalid_hex(self):
+        self.connection.execute_stream_into = lambda operation, write: write(b'name\n')
+        self.assertRaises(pymonetdb.InterfaceError, self.cursor.fetch_lob,
+                          'select data from docs', sink=BytesIO())
+
+
+class TestFetchBatches(unittest.TestCase):
+    def setUp(self):
+        tuples = {1: ['[ %d,\t"r%d"\t]\n' % (i, i) for i in range(10)]}
+        response = (table_header(1, 10, ['a', 'b'], ['int', 'varchar'], 3) +
+                    ''.join(tuples[1][:3]))
+        self.connection = FakeConnection(response, tuples)
+        self.cursor = Cursor(self.connection)
+        self.cursor.execute('select ...')
+
+    def test_rows(self):
+        first = self.cursor._rows
+        batches = list(self.cursor.fetch_batches(size=4))
+        self.assertIs(batches[0], first)
+        self.assertEqual([len(b) for b in batches], [3, 4, 3])
+        self.assertEqual(sum(batches, []), [(i, 'r%d' % i) for i in range(10)])
+        self.assertEqual(self.connection.commands, ['Xexport 1 3 4', 'Xexport 1 7 3'])
+        self.assertEqual(self.cursor.fetchone(), None)
+
+    def test_columns_after_fetchone(self):
+        self.cursor.fetchone()
+        batches = list(self.cursor.fetch_batches(size=5, layout='columns'))
+        self.assertEqual(batches[0], [(1, 2), ('r1', 'r2')])
+        self.assertEqual(batches[1][0], (3, 4, 5, 6, 7))
+
+    def test_array(self):
+        batches = list(self.cursor.fetch_batches(size=7, layout='array'))
+        self.assertEqual([len(b) for b in batches], [3, 7])
+        self.assertEqual(batches[1].columns[0].values.tolist(), list(range(3, 10)))
+        self.assertEqual(list(batches[1][0]), [3, 'r3'])
+
+    def test_dictionary(self):
+        batch = next(self.cursor.fetch_batches(layout='dictionary'))
+        self.assertEqual(batch.columns[1].values, ['r0', 'r1', 'r2'])
+        self.assertEqual(list(batch.columns[1].codes), [0, 1, 2])
+
+    def test_unknown_layout(self):
+        self.assertRaises(pymonetdb.ProgrammingError, self.cursor.fetch_batches,
+                          layout='diagonal')
@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import socket
+import time
+import unittest
+from mock import patch
+from pymonetdb import mapi
+
+
+class HandshakeTest(unittest.TestCase):
+    """Tests the login response to server challenges with and without
+       support for handshake options"""
+
+    def setUp(self):
+        self.con = mapi.Connection()
+        self.con.username = 'monetdb'
+        self.con.password = 'monetdb'
+        self.con.language = 'sql'
+        self.con.database = 'demo'
+        self.con.handshake_options = [
+            mapi.HandshakeOption(1, 'auto_commit', True, 'Xauto_commit 1'),
+            mapi.HandshakeOption(2, 'reply_size', 100, 'Xreply_size 100'),
+            mapi.HandshakeOption(5, 'time_zone', 3600, 'sSET TIME ZONE ...'),
+        ]
+
+    def test_old_server(self):
+        challenge = 'salt:mserver:9:SHA1,MD5:LIT:SHA512:'
+        response = self.con._challenge_response(challenge)
+        self.assertTrue(response.endswith(':sql:demo:'))
+        self.assertEqual([o.sent for o in self.con.handshake_options],
+                         [False, False, False])
+
+    def test_options_level(self):
+        challenge = 'salt:mserver:9:SHA1,MD5:LIT:SHA512:sql=5:BINARY=1:'
+        response = self.con._challenge_response(challenge)
+        self.assertTrue(response.endswith(':sql:demo:auto_commit=1,reply_size=100:'))
+        self.assertEqual([o.sent for o in self.con.handshake_options],
+                         [True, True, False])
+
+    def test_file_transfer(self):
+        self.con.file_transfer = True
+        challenge = 'salt:mserver:9:SHA1,MD5:LIT:SHA512:sql=6:'
+        response = self.con._challenge_response(challenge)
+        self.assertTrue(response.endswith(':demo:FILETRANS:auto_commit=1,'
+                                          'reply_size=100,time_zone=3600:'))
+
+
+class RedirectCacheTest(unittest.TestCase):
+    """Tests reusing the mserver5 merovingian redirected to"""
+
+    origin = ('localhost', 50000, 'demo')
+
+    def setUp(self):
+        mapi.clear_redirects()
+        self.addCleanup(mapi.clear_redirects)
+
+    def connect(self, con):
+        con.connect(hostname='localhost', port=50000, database='demo',
+                    username='monetdb', password='monetdb', language='sql')
+
+    def test_redirect_cached(self):
+        con = mapi.Connection()
+        con.username = con.password = 'monetdb'
+        con.language = 'sql'
+        con.database = 'demo'
+        con._origin = self.origin
+        con.socket = socket.socket()
+        self.addCleanup(con.socket.close)
+        blocks = ['salt:merovingian:9:SHA1,MD5:LIT:SHA512:',
+                  '^mapi:monetdb://db1:50001/demo\n']
+        con._getblock = lambda: blocks.pop(0)
+        con._putblock = lambda block: None
+        with patch.object(con, 'connect') as connect:
+            con._login()
+        self.assertEqual(connect.call_args[1]['hostname'], 'db1')
+        self.assertEqual(mapi._cached_redirect(self.origin),
+                         ('db1', 50001, 'demo'))
+
+    @patch('pymonetdb.mapi.Connection._open')
+    def test_connect_uses_cache(self, _open):
+        mapi._redirects[self.origin] = ('db1', 50001, 'demo', time.time() + 60)
+        con = mapi.Connection()
+        self.connect(con)
+        self.assertEqual(_open.call_count, 1)
+        self.assertEqual((con.hostname, con.port), ('db1', 50001))
+
+    @patch('pymonetdb.mapi.Connection._open')
+    def test_invalidated_on_failure(self, _open):
+        mapi._redirects[self.origin] = ('db1', 50001, 'demo', time.time() + 60)
+        _open.side_effect = [socket.error("connection refused"), None]
+        con = mapi.Connection()
+        self.connect(con)
+        self.assertEqual(_open.call_count, 2)
+        self.assertEqual((con.hostname, con.port), ('localhost', 50000))
+        self.assertEqual(mapi._cached_redirect(self.origin), None)
+
+    def test_expired(self):
+        mapi._redirects[self.origin] = ('db1', 50001, 'demo', time.time() - 1)
+        self.assertEqual(mapi._cached_redirect(self.origin), None)
+        self.assertFalse(mapi._redirects)
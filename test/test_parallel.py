@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import io
+import threading
+import unittest
+from collections import namedtuple
+from mock import patch
+import pymonetdb
+from pymonetdb import parallel
+
+Column = namedtuple('Column', 'name')
+
+# the chunks loaded by all FakeConnections
+loaded = []
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = [Column('id'), Column('name')]
+
+    def copy_from(self, table, data, format='csv', rows=None):
+        if 'fail' in data:
+            raise pymonetdb.DataError("bad row")
+        with self.connection.lock:
+            loaded.append((table, data, format, rows))
+        return rows
+
+    def execute(self, query, parameters=None):
+        self.connection.queries.append((query, parameters))
+        self.query = query
+        self.parameters = parameters
+
+    def fetchall(self):
+        if self.parameters:
+            return [(self.parameters['low'], 'x')]
+        low = int(self.query.split('>= ')[1].split(' ')[0])
+        return [(low, 'a'), (low + 1, 'b')]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Answers every partition query with rows derived from the query"""
+    made = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.thread = threading.current_thread()
+        self.queries = []
+        self.mapi = True
+        self.lock = threading.Lock()
+        self.committed = False
+        self.made.append(self)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.mapi = None
+
+    def run_transaction(self, fn, retries=5):
+        self.retries = retries
+        return fn(self)
+
+    def commit(self):
+        self.committed = True
+
+
+@patch('pymonetdb.sql.connections.Connection', FakeConnection)
+class ReadTest(unittest.TestCase):
+    def setUp(self):
+        FakeConnection.made = []
+
+    def test_key_ranges(self):
+        self.assertEqual(parallel.key_ranges('id', 0, 100, 3),
+                         ['(id < 33 OR id IS NULL)', 'id >= 33 AND id < 67',
+                          'id >= 67'])
+        self.assertEqual(parallel.key_ranges('id', 0, 1, 1), ['TRUE'])
+
+    def test_rows_in_partition_order(self):
+        partitions = ['id >= %d AND id < %d' % (i, i + 10)
+                      for i in range(0, 100, 10)]
+        rows = parallel.read('SELECT * FROM t WHERE {partition}', partitions,
+                             connections=3, database='demo')
+        self.assertEqual(list(rows), [(i + j, n) for i in range(0, 100, 10)
+                                      for (j, n) in ((0, 'a'), (1, 'b'))])
+        self.assertTrue(1 <= len(FakeConnection.made) <= 3)
+        for connection in FakeConnection.made:
+            self.assertEqual(connection.kwargs, {'database': 'demo',
+                                                 'autocommit': True})
+            self.assertIsNone(connection.mapi)
+
+    def test_parameters(self):
+        rows = parallel.read('SELECT * FROM t WHERE id >= %(low)s',
+                             [{'low': 1}, {'low': 2}], connections=2,
+                             database='demo')
+        self.assertEqual(list(rows), [(1, 'x'), (2, 'x')])
+
+    @unittest.skipIf(parallel.pandas is None, "pandas not installed")
+    def test_pandas(self):
+        frame = parallel.read('SELECT * FROM t WHERE {partition}',
+                              ['id >= 0', 'id >= 5'], output='pandas',
+                              database='demo')
+        self.assertEqual(list(frame.columns), ['id', 'name'])
+        self.assertEqual(list(frame['id']), [0, 1, 5, 6])
+
+    def test_bad_executor(self):
+        self.assertRaises(pymonetdb.ProgrammingError, parallel.read,
+                          'SELECT 1', [], executor='fiber')
+
+
+@patch('pymonetdb.sql.connections.Connection', FakeConnection)
+class ParallelLoaderTest(unittest.TestCase):
+    def setUp(self):
+        FakeConnection.made = []
+        del loaded[:]
+
+    def test_rows_per_chunk(self):
+        loader = parallel.ParallelLoader('t', workers=3, chunk_rows=4,
+                                         retries=2, database='demo')
+        report = loader.load((i, 'r%d' % i) for i in range(10))
+        self.assertEqual(report.rows, 10)
+        self.assertEqual(sorted(rows for (_, _, _, rows) in loaded), [2, 4, 4])
+        lines = sum((data.splitlines() for (_, data, _, _) in loaded), [])
+        self.assertEqual(sorted(lines),
+                         sorted('%d,"r%d"' % (i, i) for i in range(10)))
+        self.assertEqual(sum(r.rows for r in loader.reports), 10)
+        for connection in FakeConnection.made:
+            self.assertTrue(connection.kwargs['autocommit'])
+            self.assertEqual(connection.retries, 2)
+            self.assertIsNone(connection.mapi)
+
+    def test_text_file(self):
+        loader = parallel.ParallelLoader('t', workers=2, chunk_rows=2,
+                                         database='demo')
+        loader.load(io.StringIO(u"1\ta\n2\tb\n3\tc\n"), format='tsv')
+        self.assertEqual(sorted(rows for (_, _, _, rows) in loaded), [1, 2])
+        self.assertEqual(set(f for (_, _, f, _) in loaded), set(['tsv']))
+
+    def test_csv_records_span_lines(self):
+        loader = parallel.ParallelLoader('t', workers=1, chunk_rows=2,
+                                         database='demo')
+        loader.load(io.StringIO(u'1,"a\nb"\n2,"c\\"\n"\n3,"d"\n'))
+        self.assertEqual([(data, rows) for (_, data, _, rows) in loaded],
+                         [(u'1,"a\nb"\n2,"c\\"\n"\n', 2), (u'3,"d"\n', 1)])
+
+    def test_csv_unterminated(self):
+        loader = parallel.ParallelLoader('t', workers=1, chunk_rows=2,
+                                         database='demo')
+        self.assertRaises(pymonetdb.ProgrammingError, loader.load,
+                          io.StringIO(u'1,"a\n2,"b"\n'))
+
+    def test_frame(self):
+        loader = parallel.ParallelLoader('t', workers=2, chunk_rows=2,
+                                         database='demo')
+        loader.load({'a': [1, 2, 3]})
+        self.assertEqual(set(t for (t, _, _, _) in loaded), set(['t ("a")']))
+
+    def test_final_commit(self):
+        loader = parallel.ParallelLoader('t', workers=2, chunk_rows=1,
+                                         commit='final', database='demo')
+        loader.load([(1,), (2,), (3,)])
+        for connection in FakeConnection.made:
+            self.assertFalse(connection.kwargs['autocommit'])
+            self.assertTrue(connection.committed)
+
+    def test_final_error_no_commit(self):
+        loader = parallel.ParallelLoader('t', workers=2, chunk_rows=1,
+                                         commit='final', database='demo')
+        self.assertRaises(pymonetdb.DataError, loader.load,
+                          [(1,), ('fail',), (3,)])
+        for connection in FakeConnection.made:
+            self.assertFalse(connection.committed)
+            self.assertIsNone(connection.mapi)
@@ -0,0 +1,86 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import unittest
+from mock import patch, Mock
+import pymonetdb
+
+
+class PipelineTest(unittest.TestCase):
+    """Tests for mapi.Connection.pipeline. The MonetDB server is mocked, it
+       answers every block with the next prepared response."""
+
+    def setUp(self):
+        self.con = pymonetdb.mapi.Connection()
+        self.con.state = pymonetdb.mapi.STATE_READY
+        self.events = []
+        self.responses = []
+
+    def putblock(self, block):
+        self.events.append(('put', block))
+
+    def getblock(self):
+        self.events.append(('get',))
+        return self.responses.pop(0)
+
+    def run_pipeline(self, operations, window):
+        with patch.object(self.con, '_putblock', side_effect=self.putblock), \
+                patch.object(self.con, '_getblock', side_effect=self.getblock):
+            return self.con.pipeline(operations, window)
+
+    def test_window(self):
+        self.responses = ['&2 1 -1\n'] * 3
+        self.run_pipeline(['s1;', 's2;', 's3;'], window=2)
+        self.assertEqual(self.events, [('put', 's1;'), ('put', 's2;'), ('get',),
+                                       ('put', 's3;'), ('get',), ('get',)])
+
+    def test_errors_per_command(self):
+        self.responses = ['&2 1 -1\n', '!42S02!no such table\n', '&2 2 -1\n']
+        results = self.run_pipeline(['s1;', 's2;', 's3;'], window=8)
+        self.assertEqual([r.operation for r in results], ['s1;', 's2;', 's3;'])
+        self.assertEqual(results[0].response, '&2 1 -1\n')
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, pymonetdb.OperationalError)
+        self.assertEqual(results[2].response, '&2 2 -1\n')
+
+    def test_incomplete_command(self):
+        self.con.socket = Mock()
+        self.responses = [pymonetdb.mapi.MSG_MORE, '&2 1 -1\n']
+        results = self.run_pipeline(["sSELECT 'a;", "s2;", "s3;"], window=2)
+        self.assertIsInstance(results[0].error, pymonetdb.ProgrammingError)
+        self.assertIsInstance(results[1].error, pymonetdb.OperationalError)
+        self.assertIsInstance(results[2].error, pymonetdb.OperationalError)
+        self.assertEqual(self.con.state, pymonetdb.mapi.STATE_INIT)
+
+    def test_unterminated_command(self):
+        self.assertRaises(pymonetdb.ProgrammingError, self.run_pipeline,
+                          ['sSELECT 1', 's2;'], window=2)
+        self.assertEqual(self.events, [])
+
+    def test_incomplete_last_command(self):
+        self.responses = ['&2 1 -1\n', pymonetdb.mapi.MSG_MORE, '&2 2 -1\n']
+        results = self.run_pipeline(['s1;', 'sCOPY ...'], window=2)
+        self.assertEqual(results[1].response, '&2 2 -1\n')
+        self.assertEqual(self.events[-2:], [('put', ''), ('get',)])
+
+
+class RawResponseTest(unittest.TestCase):
+    """Result rows are returned undecoded by cmd(raw=True)"""
+
+    def setUp(self):
+        self.con = pymonetdb.mapi.Connection()
+        self.con.state = pymonetdb.mapi.STATE_READY
+        self.con._putblock = lambda block: None
+
+    def test_rows_raw(self):
+        self.con._getblock = lambda raw=False: b'&1 0 1 1 1\n[ 1\t]\n'
+        self.assertEqual(self.con.cmd('sSELECT 1;', raw=True), b'&1 0 1 1 1\n[ 1\t]\n')
+
+    def test_other_responses_decoded(self):
+        self.con._getblock = lambda raw=False: b'!42000!syntax error\n'
+        self.assertRaises(pymonetdb.OperationalError, self.con.cmd, 'sSELEC;', raw=True)
+        self.con._getblock = lambda raw=False: b'&2 1 -1\n'
+        self.assertEqual(self.con.cmd('sINSERT ...;', raw=True), '&2 1 -1\n')
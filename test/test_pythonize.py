@@ -5,6 +5,7 @@
 # Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
 
 import unittest
+from decimal import Decimal
 import pymonetdb.sql.pythonize
 
 class TestPythonize(unittest.TestCase):
@@ -19,3 +20,41 @@ class TestPythonize(unittest.TestCase):
         result2 = pymonetdb.sql.pythonize.Binary(input2)
         self.assertEqual(output2, result2)
 
+    def test_decode_tuples(self):
+        rows = pymonetdb.sql.pythonize.decode_tuples('[ 1,\t"a"\t]\n[ NULL,\tNULL\t]',
+                                                    ['int', 'varchar'])
+        self.assertEqual(rows, [(1, 'a'), (None, None)])
+        self.assertRaises(pymonetdb.InterfaceError,
+                          pymonetdb.sql.pythonize.decode_tuples, '[ 1\t]',
+                          ['int', 'int'])
+
+    def test_numeric_tuples(self):
+        lines = ['[ 1,\t2.5,\t3.25\t]', '[ NULL,\t-1e3,\tNULL\t]']
+        types = ['int', 'double', 'decimal']
+        rows = pymonetdb.sql.pythonize.convert_tuples(lines, types)
+        self.assertEqual(rows, [(1, 2.5, Decimal('3.25')), (None, -1000.0, None)])
+        self.assertEqual(rows, [pymonetdb.sql.pythonize.parse_tuple(line, types)
+                                for line in lines])
+        self.assertRaises(pymonetdb.InterfaceError,
+                          pymonetdb.sql.pythonize.convert_tuples, ['[ 1\t]'],
+                          ['int', 'int'])
+
+    def test_bytes_tuples(self):
+        types = ['int', 'double', 'decimal']
+        lines = [b'[ 1,\t2.5,\t3.25\t]', b'[ NULL,\t-1e3,\tNULL\t]']
+        self.assertEqual(pymonetdb.sql.pythonize.convert_tuples(lines, types),
+                         [(1, 2.5, Decimal('3.25')), (None, -1000.0, None)])
+        line = u'[ 1,\t"\u00e9",\tNULL\t]'.encode('utf-8')
+        self.assertEqual(pymonetdb.sql.pythonize.parse_tuple(line, ['int', 'varchar', 'clob']),
+                         (1, u'\u00e9', None))
+
+    def test_string_dictionaries(self):
+        types = ['int', 'varchar']
+        dictionaries = pymonetdb.sql.pythonize.string_dictionaries(types)
+        self.assertEqual(dictionaries, [None, {}])
+        lines = [b'[ 1,\t"nl"\t]', b'[ 2,\t"nl"\t]', b'[ 3,\tNULL\t]']
+        rows = pymonetdb.sql.pythonize.convert_tuples(lines, types, dictionaries)
+        self.assertEqual(rows, [(1, 'nl'), (2, 'nl'), (3, None)])
+        self.assertIs(rows[0][1], rows[1][1])
+        more = pymonetdb.sql.pythonize.convert_tuples(lines[:1], types, dictionaries)
+        self.assertIs(more[0][1], rows[0][1])
@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import datetime
+import unittest
+from decimal import Decimal
+import pymonetdb
+from pymonetdb.sql import storage
+from pymonetdb.sql.cursors import Description
+from pymonetdb.sql.storage import (SpillingResult, WindowCache, ArrayResult,
+                                   estimate_size, INT64)
+
+
+def description(*types):
+    return [Description('c%d' % i, t, None, None, None, None, None)
+            for (i, t) in enumerate(types)]
+
+
+class TestSpillingResult(unittest.TestCase):
+    def setUp(self):
+        self.rows = [(i, i / 2.0, i % 2 == 0, u'row \u00e9 %d' % i,
+                      Decimal(i) / 4, datetime.date(2020, 1, 1 + i % 28))
+                     for i in range(1000)]
+        self.rows[3] = (None,) * 6
+        self.result = SpillingResult(description('int', 'double', 'boolean',
+                                                 'varchar', 'decimal', 'date'),
+                                     memory_limit=20000)
+        self.addCleanup(self.result.close)
+        for i in range(0, 1000, 100):
+            self.result.extend(self.rows[i:i + 100])
+
+    def test_spills(self):
+        self.assertEqual(len(self.result), 1000)
+        self.assertTrue(self.result.spilled > 0)
+        self.assertTrue(len(self.result._rows) * self.result._row_size <= 20000)
+
+    def test_random_access(self):
+        self.assertEqual(self.result[0], self.rows[0])
+        self.assertEqual(self.result[3], self.rows[3])
+        self.assertEqual(self.result[-1], self.rows[-1])
+        self.assertEqual(self.result[450:460], self.rows[450:460])
+        self.assertEqual(self.result[::97], self.rows[::97])
+        self.assertRaises(IndexError, lambda: self.result[1000])
+
+    def test_iteration(self):
+        self.assertEqual(list(self.result), self.rows)
+
+    def test_close(self):
+        self.result.close()
+        self.assertEqual(len(self.result), 0)
+
+    def test_in_memory(self):
+        result = SpillingResult(description('int'))
+        result.extend([(1,), (2,)])
+        self.assertEqual(result.spilled, 0)
+        self.assertEqual(result, [(1,), (2,)])
+
+
+class TestWindowCache(unittest.TestCase):
+    def test_least_recently_used_evicted(self):
+        rows = [(i,) for i in range(10)]
+        cache = WindowCache()
+        cache.put(1, 0, rows)
+        self.assertIsNone(cache.find(1, 0))
+        # room for two windows
+        cache.limit = int(estimate_size(rows) * 2.5)
+        cache.put(1, 0, rows)
+        cache.put(1, 10, rows)
+        self.assertEqual(cache.find(1, 5), (0, rows))
+        cache.put(1, 20, rows)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.find(1, 15))
+        self.assertEqual(cache.find(1, 29), (20, rows))
+        self.assertIsNone(cache.find(2, 5))
+
+
+class TestArrayResult(unittest.TestCase):
+    def setUp(self):
+        self.rows = [(i, i / 2.0, i % 2 == 0, u'row \u00e9 %d' % i,
+                      Decimal(i) / 4) for i in range(50)]
+        self.rows[3] = (None,) * 5
+        self.result = ArrayResult(description('int', 'double', 'boolean',
+                                              'varchar', 'decimal'))
+        self.result.extend(self.rows[:2])
+        self.result.extend(self.rows[2:])
+
+    def test_storage(self):
+        ints, floats, bools, strings, decimals = self.result.columns
+        self.assertEqual((ints.values.typecode, floats.values.typecode,
+                          bools.values.typecode), (INT64, 'd', 'b'))
+        self.assertEqual(len(ints.values), 50)
+        self.assertEqual(list(ints.nulls[:5]), [0, 0, 0, 1, 0])
+        self.assertIsInstance(strings.data, bytearray)
+        self.assertEqual(decimals[4], Decimal(1))
+
+    def test_rows(self):
+        self.assertEqual(len(self.result), 50)
+        self.assertEqual(list(self.result), self.rows)
+        self.assertEqual(self.result[3], (None,) * 5)
+        self.assertEqual(self.result[-1], self.rows[-1])
+        self.assertEqual(self.result[10:13], self.rows[10:13])
+        self.assertIs(self.result[2][2], True)
+        self.assertEqual(self.result[5][3:], self.rows[5][3:])
+        self.assertRaises(IndexError, lambda: self.result[50])
+
+    def test_column(self):
+        self.assertEqual(self.result.column('c1'), [row[1] for row in self.rows])
+        self.assertEqual(self.result.column(3), [row[3] for row in self.rows])
+
+
+class TestDictionaryColumns(unittest.TestCase):
+    def setUp(self):
+        self.rows = [(i, [u'nl', u'de', None][i % 3]) for i in range(9)]
+        self.result = ArrayResult(description('int', 'varchar'), self.rows,
+                                  dictionary=True)
+
+    def test_encoded(self):
+        column = self.result.columns[1]
+        self.assertEqual(column.values, [u'nl', u'de'])
+        self.assertEqual(list(column.codes), [0, 1, -1] * 3)
+        self.assertEqual(list(self.result), self.rows)
+        self.assertRaises(pymonetdb.ProgrammingError, self.result.categorical, 'c0')
+
+    @unittest.skipIf(storage.pandas is None, "pandas not installed")
+    def test_categorical(self):
+        categorical = self.result.categorical('c1')
+        self.assertEqual(list(categorical.categories), [u'nl', u'de'])
+        self.assertEqual(list(categorical.codes), [0, 1, -1] * 3)
+
+    @unittest.skipIf(storage.pyarrow is None, "pyarrow not installed")
+    def test_dictionary_array(self):
+        array = self.result.dictionary_array(1)
+        self.assertEqual(array.to_pylist(), [row[1] for row in self.rows])
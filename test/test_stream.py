@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0.  If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright 1997 - July 2008 CWI, August 2008 - 2016 MonetDB B.V.
+
+import itertools
+import struct
+import unittest
+from mock import patch
+import pymonetdb
+
+
+class StreamResponseTest(unittest.TestCase):
+    """Tests for mapi.Connection.cmd_stream, which passes the raw response
+       packets on to a callback. The MonetDB server is mocked."""
+
+    def setUp(self):
+        self.con = pymonetdb.mapi.Connection()
+        self.con.state = pymonetdb.mapi.STATE_READY
+        self.written = []
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_data_and_trailer(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'1,"a"\n2,"b', b'"\n3,"c"\n&2 3 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'1,"a"\n2,"b"\n3,"c"\n')
+        self.assertEqual(trailer, '&2 3 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_trailer_across_packets(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'1\n2\n&2 ', b'2 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'1\n2\n')
+        self.assertEqual(trailer, '&2 2 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_trailing_empty_rows(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'1\n\n', b'\n&2 3 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'1\n\n\n')
+        self.assertEqual(trailer, '&2 3 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_rows_like_protocol_lines(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'a\tb\n#c\td\n!e\tf\n&2 3 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'a\tb\n#c\td\n!e\tf\n')
+        self.assertEqual(trailer, '&2 3 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_first_row_like_info(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'#tag,1\n2,x\n&2 2 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'#tag,1\n2,x\n')
+        self.assertEqual(trailer, '&2 2 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_first_row_like_error(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'!bang,1\n', b'2,x\n&2 2 -1\n'])
+        trailer = self.con.cmd_stream('sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'!bang,1\n2,x\n')
+        self.assertEqual(trailer, '&2 2 -1')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_error_after_data(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'1\n2\n!42000!failed\n'])
+        self.assertRaises(pymonetdb.DatabaseError, self.con.cmd_stream,
+                          'sCOPY ...', self.written.append)
+        self.assertEqual(b''.join(self.written), b'1\n2\n')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getpackets')
+    def test_error(self, mock_getpackets, mock_putblock):
+        mock_getpackets.return_value = iter([b'!42S02!no such table\n'])
+        self.assertRaises(pymonetdb.OperationalError, self.con.cmd_stream,
+                          'sCOPY ...', self.written.append)
+        self.assertEqual(self.written, [])
+
+
+class FakeSocket(object):
+    """Collects everything sent to it"""
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+class UploadTest(unittest.TestCase):
+    """Tests for the ON CLIENT file upload protocol of mapi.Connection"""
+
+    def setUp(self):
+        self.con = pymonetdb.mapi.Connection()
+        self.con.state = pymonetdb.mapi.STATE_READY
+        self.con.socket = FakeSocket()
+
+    def test_putbuffers_packets(self):
+        data = b'x' * (pymonetdb.mapi.MAX_PACKAGE_LENGTH + 10)
+        self.con._putbuffers([data[:5], data[5:]])
+        flags = [struct.unpack('<H', s)[0] for s in self.con.socket.sent[::2]]
+        lengths = [len(s) for s in self.con.socket.sent[1::2]]
+        self.assertEqual(lengths, [5, pymonetdb.mapi.MAX_PACKAGE_LENGTH, 5])
+        self.assertEqual([f & 1 for f in flags], [0, 0, 1])
+        self.assertEqual(b''.join(self.con.socket.sent[1::2]), data)
+
+    def test_putbuffers_empty(self):
+        self.con._putbuffers([])
+        self.assertEqual(self.con.socket.sent, [struct.pack('<H', 1)])
+
+    @patch('pymonetdb.mapi.Connection._getblock')
+    def test_cmd_chunks(self, mock_getblock):
+        mock_getblock.return_value = '&2 2 -1\n'
+        rows = (u'(%d, \'\u00e9\')' % i for i in range(2000))
+        chunks = itertools.chain([b'sINSERT INTO t VALUES '],
+                                 itertools.islice(rows, 1), (u',' + row for row in rows),
+                                 ['\n;'])
+        response = self.con.cmd_chunks(chunks)
+        self.assertEqual(response, '&2 2 -1\n')
+        data = b''.join(self.con.socket.sent[1::2]).decode('utf-8')
+        self.assertTrue(data.startswith(u"sINSERT INTO t VALUES (0, '\u00e9'),(1, "))
+        self.assertTrue(data.endswith(u"(1999, '\u00e9')\n;"))
+        # the small fragments are sent in a few packets
+        lengths = [len(s) for s in self.con.socket.sent[1::2]]
+        self.assertTrue(len(lengths) < 10)
+        self.assertTrue(max(lengths) <= pymonetdb.mapi.MAX_PACKAGE_LENGTH)
+
+    def test_cmd_chunks_failing(self):
+        def chunks():
+            yield 'sINSERT INTO t VALUES (1)'
+            raise ValueError()
+        self.assertRaises(ValueError, self.con.cmd_chunks, chunks())
+        self.assertEqual(self.con.state, pymonetdb.mapi.STATE_INIT)
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getblock')
+    def test_upload(self, mock_getblock, mock_putblock):
+        mock_getblock.side_effect = ['rb 0\n' + pymonetdb.mapi.MSG_FILETRANS,
+                                     '&2 3 -1\n']
+        requests = []
+
+        def uploader(filename, binary, offset):
+            requests.append((filename, binary, offset))
+            return [b'abc']
+        self.con.uploader = uploader
+        self.assertEqual(self.con.cmd('sCOPY ...'), '&2 3 -1\n')
+        self.assertEqual(requests, [('0', True, 0)])
+        self.assertEqual(b''.join(self.con.socket.sent[1::2]), b'\nabc')
+
+    @patch('pymonetdb.mapi.Connection._putblock')
+    @patch('pymonetdb.mapi.Connection._getblock')
+    def test_upload_refused(self, mock_getblock, mock_putblock):
+        mock_getblock.side_effect = ['r 0 data.csv\n' + pymonetdb.mapi.MSG_FILETRANS,
+                                     '!HY000!upload refused\n']
+        self.assertRaises(pymonetdb.OperationalError, self.con.cmd, 'sCOPY ...')
+        self.assertTrue(mock_putblock.call_args_list[-1][0][0].startswith('!'))